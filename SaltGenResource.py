@@ -9,37 +9,112 @@ added as a node attribute or tag.
 
 """
 
+import bisect
+import collections.abc
+import contextlib
+import copy
+import filecmp
+import fnmatch
+import glob
+import hashlib
+import io
+import json
 import logging
+import optparse
 import os
+import platform
+import random
+import re
 import sys
+import tempfile
+import threading
+import time
+import unicodedata
+from xml.etree import ElementTree
+from xml.sax import saxutils
 import yaml
 
-import salt.client
-import salt.utils
-import salt.grains
-import salt.version as version
-import salt.utils.parsers
-import salt.syspaths as syspaths
-import salt.config as config
-import salt.utils.args as saltargs
-import salt.utils.data as datautils
-import salt.utils.stringutils as stringutils
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 LOG = logging.getLogger("salt-gen-resource")
 
+# The Salt modules are bound by _load_salt(), which also defines the option
+# parser built on them, SaltNodesCommandParser. Importing Salt takes far
+# longer than serving a cached document, so it is deferred until it is
+# actually needed.
+salt = version = syspaths = config = saltargs = datautils = stringutils = None
 
-# noinspection PyClassHasNoInit
-# pylint: disable=no-init
-class SaltNodesCommandParser(
-    salt.utils.parsers.OptionParser,
-    salt.utils.parsers.ConfigDirMixIn,
-    salt.utils.parsers.ExtendedTargetOptionsMixIn,
-    salt.utils.parsers.LogLevelMixIn,
-    metaclass=salt.utils.parsers.OptionParserMeta,
-):
+
+def _load_salt():
+    """
+    Import the Salt modules used by this script, define SaltNodesCommandParser
+    on the Salt option parser classes, and return it
+    """
+    # pylint: disable=global-statement,import-outside-toplevel,redefined-outer-name
+    global salt, version, syspaths, config, saltargs, datautils, stringutils
+
+    if salt is None:
+        import salt.client
+        import salt.utils
+        import salt.grains
+        import salt.loader
+        import salt.payload
+        import salt.version as version
+        import salt.utils.parsers
+        import salt.syspaths as syspaths
+        import salt.config as config
+        import salt.utils.args as saltargs
+        import salt.utils.data as datautils
+        import salt.utils.stringutils as stringutils
+
+    # Already defined, or replaced by a test
+    parser = globals().get("SaltNodesCommandParser")
+    if parser is not None:
+        return parser
+
+    # noinspection PyClassHasNoInit
+    # pylint: disable=no-init
+    class SaltNodesCommandParser(
+        SaltNodesOptionsMixIn,
+        salt.utils.parsers.OptionParser,
+        salt.utils.parsers.ConfigDirMixIn,
+        salt.utils.parsers.ExtendedTargetOptionsMixIn,
+        salt.utils.parsers.LogLevelMixIn,
+        metaclass=salt.utils.parsers.OptionParserMeta,
+    ):
+        """
+        Argument parser used by SaltGenResource to generate
+        Rundeck node definitions.
+        """
+
+        __qualname__ = "SaltNodesCommandParser"
+        _default_logging_logfile_ = os.path.join(syspaths.LOGS_DIR, "resource-generator")
+
+    globals()["SaltNodesCommandParser"] = SaltNodesCommandParser
+    return SaltNodesCommandParser
+
+
+def __getattr__(name):
+    """
+    Load Salt when SaltNodesCommandParser is first imported from this module
     """
-    Argument parser used by SaltGenResource to generate
-    Rundeck node definitions.
+    if name == "SaltNodesCommandParser":
+        return _load_salt()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+class SaltNodesOptionsMixIn:
+    """
+    Options of SaltNodesCommandParser, which combines this mix-in with
+    the Salt option parser classes when Salt is loaded
     """
 
     usage = "%prog [options] <target> [<attr>=<value> ...]"
@@ -49,7 +124,6 @@ class SaltNodesCommandParser(
     _config_filename_ = "minion"
     _logfile_config_setting_name_ = "resource_generator_logfile"
     _logfile_loglevel_config_setting_name_ = "resource_generator_log_level_logfile"
-    _default_logging_logfile_ = os.path.join(syspaths.LOGS_DIR, "resource-generator")
     _setup_mp_logging_listener_ = False
     _default_logging_level_ = "warning"
 
@@ -64,6 +138,22 @@ class SaltNodesCommandParser(
     ]
     ignore_servernode = ["username", "description"]
 
+    # Targeting types accepted by --target-spec and in batch profiles
+    target_types = [
+        "glob",
+        "pcre",
+        "list",
+        "grain",
+        "grain_pcre",
+        "pillar",
+        "pillar_pcre",
+        "pillar_exact",
+        "nodegroup",
+        "range",
+        "compound",
+        "ipcidr",
+    ]
+
     # pylint: disable=no-member
     def _mixin_setup(self):
         """
@@ -129,12 +219,309 @@ class SaltNodesCommandParser(
                 "when separated by a space or comma."
             ),
         )
+        self.add_option(
+            "--target-spec",
+            dest="target_specs",
+            type=str,
+            default=None,
+            action="append",
+            metavar="TYPE:EXPRESSION",
+            help=(
+                "Also include the minions matching this target, where TYPE "
+                "is one of {}. The Salt Mine is called for each target at "
+                "the same time, and minions matching several targets are "
+                "included once. May be given several times.".format(
+                    ", ".join(self.target_types)
+                )
+            ),
+        )
+        self.add_option(
+            "--cache-ttl",
+            type=int,
+            default=0,
+            help=(
+                "Serve previously generated output from the resource cache "
+                "when it is younger than this many seconds. "
+                "Default: 0 (caching disabled)."
+            ),
+        )
+        self.add_option(
+            "--cache-stale-ttl",
+            type=int,
+            default=0,
+            help=(
+                "Serve expired output from the resource cache when it is "
+                "younger than this many seconds, while a background process "
+                "refreshes it. Default: 0 (always refresh synchronously)."
+            ),
+        )
+        self.add_option(
+            "--cache-dir",
+            type=str,
+            default=None,
+            help=(
+                "Directory in which to store the resource cache. "
+                "Default: 'resource-generator' below the minion cachedir."
+            ),
+        )
+        self.add_option(
+            "--config-cache",
+            action="store_true",
+            help=(
+                "Keep the resolved minion configuration in the cache directory, "
+                "and reuse it while the configuration files are unchanged."
+            ),
+        )
+        self.add_option(
+            "--output-format",
+            type="choice",
+            choices=["yaml", "json", "xml"],
+            default="yaml",
+            help=(
+                "Set the format of the generated resources: yaml, json or xml. "
+                "These match the Rundeck resourceyaml, resourcejson and "
+                "resourcexml formats. Default: yaml."
+            ),
+        )
+        self.add_option(
+            "--output-file",
+            type=str,
+            default=None,
+            metavar="FILE",
+            help=(
+                "Write the resources to FILE instead of stdout. The file is "
+                "replaced atomically, and only when its content changed."
+            ),
+        )
+        self.add_option(
+            "--canonical",
+            action="store_true",
+            help=(
+                "Write the nodes in name order, with sorted tags and every "
+                "attribute value and tag as a normalized string, so that "
+                "unchanged Salt Mine data always gives the same output."
+            ),
+        )
+        self.add_option(
+            "--stream",
+            action="store_true",
+            help=(
+                "Convert and print one node at a time, instead of building "
+                "all node definitions before printing them. This reduces "
+                "memory use for large numbers of minions. Ignored when the "
+                "resource cache or --fallback is enabled."
+            ),
+        )
+        self.add_option(
+            "--fetch-timeout",
+            type=float,
+            default=0,
+            metavar="SECONDS",
+            help=(
+                "Give up fetching the Salt Mine data after this many seconds. "
+                "Default: 0 (wait for the Salt timeouts)."
+            ),
+        )
+        self.add_option(
+            "--fallback",
+            action="store_true",
+            help=(
+                "Keep the last output generated successfully in the cache "
+                "directory, and print it instead when the Salt Mine data "
+                "cannot be fetched."
+            ),
+        )
+        self.add_option(
+            "--max-node-drop",
+            type=float,
+            default=None,
+            metavar="PCT",
+            help=(
+                "Refuse to print a result with more than PCT percent fewer "
+                "nodes than the last output generated successfully, and "
+                "print that output instead. Implies --fallback."
+            ),
+        )
+        self.add_option(
+            "--single-flight",
+            type=float,
+            default=0,
+            metavar="SECONDS",
+            help=(
+                "Let only one of several concurrent runs with the same options "
+                "call the Salt Mine, while the others wait up to SECONDS to "
+                "reuse its result. Default: 0 (disabled)."
+            ),
+        )
+        self.add_option(
+            "--backend",
+            type="choice",
+            choices=["caller", "transport", "master-cache", "fixture", "synthetic"],
+            default="caller",
+            help=(
+                "Where to get the Salt Mine data from: 'caller' asks the Salt "
+                "Master through the local minion, 'transport' sends the "
+                "request straight to the Salt Master with the minion keys, "
+                "without loading the minion, 'master-cache' reads the "
+                "mine cache of a Salt Master running on this host, 'fixture' "
+                "reads a file and 'synthetic' makes up minions for testing. "
+                "Default: caller."
+            ),
+        )
+        self.add_option(
+            "--master-cache-dir",
+            type=str,
+            default=None,
+            metavar="DIR",
+            help=(
+                "The cachedir of the Salt Master, used by the master-cache "
+                "backend. Default: 'master' below the Salt cache directory."
+            ),
+        )
+        self.add_option(
+            "--fixture-file",
+            type=str,
+            default=None,
+            metavar="FILE",
+            help=(
+                "A YAML, JSON or msgpack (.p) file of Salt Mine data by "
+                "minion ID, used by the fixture backend."
+            ),
+        )
+        self.add_option(
+            "--synthetic-count",
+            type=int,
+            default=1000,
+            metavar="N",
+            help="The number of minions made up by the synthetic backend. Default: 1000.",
+        )
+        self.add_option(
+            "--print-mine-config",
+            action="store_true",
+            help=(
+                "Print a mine_functions minion configuration that makes the "
+                "Salt Mine return only the grains used by these options, "
+                "and exit."
+            ),
+        )
+        self.add_option(
+            "--incremental",
+            action="store_true",
+            help=(
+                "Keep the node definitions of each run in the cache directory, "
+                "and only convert again the minions whose grains have changed."
+            ),
+        )
+        self.add_option(
+            "--stats-file",
+            type=str,
+            default=None,
+            metavar="FILE",
+            help=(
+                "Write statistics about the generated resources to FILE "
+                "as JSON, or to stderr if FILE is '-'."
+            ),
+        )
+        self.add_option(
+            "--metrics-file",
+            type=str,
+            default=None,
+            metavar="FILE",
+            help=(
+                "After each run, write metrics in the Prometheus text format "
+                "to FILE, for the node exporter textfile collector."
+            ),
+        )
+        self.add_option(
+            "--timings",
+            action="store_true",
+            help=(
+                "Add the wall and CPU time of each stage, and the numbers of "
+                "minions, nodes, attributes, tags and warnings, to the "
+                "statistics. They are written to stderr unless --stats-file "
+                "is given."
+            ),
+        )
+        self.add_option(
+            "--profile-file",
+            type=str,
+            default=None,
+            metavar="FILE",
+            help=(
+                "Profile the conversion of the Salt Mine data into nodes "
+                "with cProfile, and write the statistics to FILE."
+            ),
+        )
+        self.add_option(
+            "--warn-examples",
+            type=int,
+            default=0,
+            metavar="N",
+            help=(
+                "Problems with requested grains are logged once for all "
+                "minions. List the first N minions affected by each problem. "
+                "Default: 0."
+            ),
+        )
+        self.add_option(
+            "--workers",
+            type=int,
+            default=1,
+            metavar="N",
+            help=(
+                "Convert the Salt Mine data of many minions in N worker "
+                "processes. The output is the same as with a single "
+                "process. Default: 1."
+            ),
+        )
+        self.add_option(
+            "--profiles",
+            type=str,
+            default=None,
+            metavar="FILE",
+            help=(
+                "Generate several resource files from one Salt Mine call. "
+                "FILE is a YAML list of profiles, each defining a target, "
+                "target_type, attributes, tags, static attributes and "
+                "output path."
+            ),
+        )
+        self.add_option(
+            "--listen",
+            type=str,
+            default=None,
+            metavar="ADDRESS:PORT",
+            help=(
+                "Run as a server for Rundeck's URL resource source, "
+                "answering HTTP requests on this address and port instead "
+                "of printing the resources once."
+            ),
+        )
+        self.add_option(
+            "--refresh-interval",
+            type=int,
+            default=60,
+            help=(
+                "When running as a server, the number of seconds between "
+                "calls to the Salt Mine. Default: 60."
+            ),
+        )
+        self.add_option(
+            "--cache-refresh",
+            action="store_true",
+            help=optparse.SUPPRESS_HELP,
+        )
 
     def _mixin_after_parsed(self):
         """
         Validate and process arguments
         """
-        if not os.path.isfile(self.get_config_file_path()):
+        # The fixture and synthetic backends work without a minion configuration
+        if not os.path.isfile(self.get_config_file_path()) and self.options.backend in (
+            "caller",
+            "transport",
+            "master-cache",
+        ):
             LOG.critical("Configuration file not found")
             sys.exit(-1)
 
@@ -148,7 +535,13 @@ class SaltNodesCommandParser(
             else:
                 self.config["tgt"] = self.args[0]
         except IndexError:
-            self.exit(42, "\nCannot execute command without defining a target.\n\n")
+            if (
+                self.options.profiles is None
+                and not self.options.print_mine_config
+                and not self.options.target_specs
+            ):
+                self.exit(42, "\nCannot execute command without defining a target.\n\n")
+            self.config["tgt"] = None
 
         if self.options.log_level:
             self.config["log_level"] = self.options.log_level
@@ -159,11 +552,128 @@ class SaltNodesCommandParser(
         if self.config["selected_target_option"] is None:
             self.config["selected_target_option"] = "glob"
 
+        # Add the targets given with --target-spec
+        targets = []
+        if self.config["tgt"] is not None:
+            targets.append((self.config["tgt"], self.config["selected_target_option"]))
+        self.options.target_specs = self.options.target_specs or []
+        for spec in self.options.target_specs:
+            tgt_type, _, tgt = spec.partition(":")
+            if tgt_type not in self.target_types or not tgt:
+                self.error(
+                    "Invalid target spec '{}'. Use TYPE:EXPRESSION, where TYPE "
+                    "is one of {}.".format(spec, ", ".join(self.target_types))
+                )
+            if tgt_type == "list":
+                tgt = tgt.replace(" ", "").split(",")
+            targets.append((tgt, tgt_type))
+        if self.config["tgt"] is None and targets:
+            self.config["tgt"], self.config["selected_target_option"] = targets[0]
+        self.config["targets"] = targets
+
         # Remove conflicting grains
         self.options.attributes = [
             x for x in self.options.attributes if x not in self.ignore_attributes
         ]
 
+        # Resolve the resource cache location
+        if self.options.cache_dir is None:
+            self.options.cache_dir = os.path.join(
+                self.config["cachedir"], "resource-generator"
+            )
+
+        if self.options.cache_ttl < 0 or self.options.cache_stale_ttl < 0:
+            self.error("Cache lifetimes must not be negative.")
+
+        if self.options.fetch_timeout < 0:
+            self.error("The fetch timeout must not be negative.")
+        if self.options.max_node_drop is not None:
+            if not 0 <= self.options.max_node_drop <= 100:
+                self.error("The maximum node drop must be between 0 and 100 percent.")
+            self.options.fallback = True
+
+        if self.options.single_flight < 0:
+            self.error("The single flight wait must not be negative.")
+        if self.options.single_flight and fcntl is None:
+            self.error("The --single-flight option is not supported on this platform.")
+
+        if self.options.workers < 1:
+            self.error("The number of workers must be at least 1.")
+        if self.options.workers > 1 and not hasattr(os, "fork"):
+            self.error("The --workers option is not supported on this platform.")
+
+        # Read the batch profiles
+        if self.options.profiles is not None:
+            try:
+                self.options.profiles = self.load_profiles(self.options.profiles)
+            except ValueError as exc:
+                self.error(str(exc))
+
+        # Resolve the Salt Master cache location
+        if self.options.backend == "master-cache" and self.options.master_cache_dir is None:
+            self.options.master_cache_dir = os.path.join(syspaths.CACHE_DIR, "master")
+
+        # Backends that do not ask the Salt Master match targets locally
+        if BACKENDS[self.options.backend].matches_locally:
+            target_types = [tgt_type for _, tgt_type in self.config["targets"]]
+            if self.options.profiles is not None:
+                target_types = [p["tgt_type"] for p in self.options.profiles]
+            for tgt_type in target_types:
+                if tgt_type not in _COMPOUND_PREFIXES:
+                    self.error(
+                        "The {} backend cannot match '{}' targets.".format(
+                            self.options.backend, tgt_type
+                        )
+                    )
+        if self.options.backend == "fixture" and self.options.fixture_file is None:
+            self.error("The fixture backend requires --fixture-file.")
+
+        # Validate the server address
+        if self.options.listen is not None:
+            host, _, port = self.options.listen.rpartition(":")
+            if not port.isdecimal():
+                self.error("The --listen option requires ADDRESS:PORT.")
+            self.options.listen = (host.strip("[]") or "127.0.0.1", int(port))
+            if self.options.refresh_interval < 1:
+                self.error("The refresh interval must be at least 1 second.")
+            # Worker processes would be forked from the threads of the server
+            if self.options.workers > 1:
+                self.error("The --workers option cannot be used with --listen.")
+
+        if self.options.output_file is not None and (
+            self.options.listen is not None or self.options.profiles is not None
+        ):
+            self.error("The --output-file option cannot be used with --listen or --profiles.")
+
+    def _minion_config(self):
+        """
+        Read the minion configuration, or with --config-cache, load it from
+        the configuration cache while the files it was read from are unchanged
+        """
+        path = self.get_config_file_path()
+        cache = None
+        if self.options.config_cache:
+            cache_dir = self.options.cache_dir or os.path.join(
+                syspaths.CACHE_DIR, "minion", "resource-generator"
+            )
+            cache = ConfigCache(cache_dir, path)
+            config_opts = cache.load()
+            if config_opts is not None:
+                # Repeat the side effect of reading the configuration
+                features = getattr(salt, "features", None)
+                if features is not None:
+                    features.setup_features(config_opts)
+                return config_opts
+
+        config_opts = config.minion_config(
+            path,
+            cache_minion_id=True,
+            ignore_config_errors=False,
+        )
+        if cache is not None:
+            cache.save(config_opts)
+        return config_opts
+
     def setup_config(self):
         """Configure file-based logging
 
@@ -172,11 +682,7 @@ class SaltNodesCommandParser(
         log file from the minion config file.
 
         """
-        config_opts = config.minion_config(
-            self.get_config_file_path(),
-            cache_minion_id=True,
-            ignore_config_errors=False,
-        )
+        config_opts = self._minion_config()
 
         # Make file based logging work
         if getattr(self.options, self._logfile_config_setting_name_, "None") is None:
@@ -242,218 +748,2678 @@ class SaltNodesCommandParser(
         This callback converts comma-delimited or space-delimited strings
         to list types.
         """
-        if "," in value:
-            setattr(parser.values, option.dest, set(value.replace(" ", "").split(",")))
-        else:
-            setattr(parser.values, option.dest, set(value.split()))
+        setattr(parser.values, option.dest, SaltNodesOptionsMixIn.split_values(value))
 
+    @staticmethod
+    def split_values(value):
+        """
+        Convert a comma-delimited or space-delimited string to a set.
+        Lists and other iterables are converted directly.
+        """
+        if not isinstance(value, str):
+            return set(value)
+        if "," in value:
+            return set(value.replace(" ", "").split(","))
+        return set(value.split())
 
-class ResourceGenerator:
-    """
-    Provide a dictionary of node definitions.
-    When written to stdout in YAML format, this dictionary is consumable
-    by Rundeck.
-    """
+    @classmethod
+    def load_profiles(cls, path):
+        """Read batch profiles from a YAML file
 
-    # Define maps from grain values into expected strings
-    _os_family_map = {"Linux": "unix", "Windows": "windows"}
-    _os_arch_map = {"x86_64": "amd64", "AMD64": "amd64"}
-    _server_node_name = "localhost"
-    _mine_func = "mine.get"
+        Args:
+            path (str): Path to a YAML file containing a list of profiles
 
-    resources = {}
+        Returns:
+            list: Profiles as dicts with the keys name, output, tgt, tgt_type,
+                  attributes, tags and static
 
-    # pylint: disable=no-member
-    def __init__(self, args=None):
-        """
-        Parse command arguments
+        Raises:
+            ValueError: Raised when the file cannot be read or is invalid
         """
-        # Call the configuration parser
-        parser = SaltNodesCommandParser()
-        parser.parse_args(args)
+        try:
+            with open(path, "r", encoding="utf-8") as stream:
+                data = yaml.safe_load(stream)
+        except (OSError, yaml.YAMLError) as exc:
+            raise ValueError(
+                "Unable to read profiles from '{}': {}".format(path, exc)
+            ) from exc
+
+        if not isinstance(data, list) or not data:
+            raise ValueError("Profile file '{}' must contain a list.".format(path))
+
+        profiles = []
+        names = set()
+        outputs = set()
+        for index, item in enumerate(data):
+            name = str(item.get("name", index)) if isinstance(item, dict) else index
+            if not isinstance(item, dict) or "target" not in item or "output" not in item:
+                raise ValueError(
+                    "Profile '{}' must define 'target' and 'output'.".format(name)
+                )
 
-        # Removing 'conf_file' prevents the file from being re-read when rendering grains
-        parser.config.pop("conf_file", None)
+            tgt_type = item.get("target_type", "glob")
+            if tgt_type not in cls.target_types:
+                raise ValueError(
+                    "Profile '{}' has unknown target_type '{}'.".format(name, tgt_type)
+                )
+            tgt = item["target"]
+            if tgt_type == "list" and isinstance(tgt, list):
+                valid = all(isinstance(x, str) and x for x in tgt)
+            else:
+                valid = isinstance(tgt, str)
+            if not valid or not tgt:
+                raise ValueError(
+                    "Profile '{}' has invalid target {!r}. Use a string, or with "
+                    "target_type list, a list of minion IDs.".format(name, tgt)
+                )
+            if tgt_type == "list":
+                tgt = sorted(cls.split_values(tgt))
 
-        # Parse the static attribute definitions
-        self.static = saltargs.parse_input(parser.args, False)[1]
+            output = item["output"]
+            if not isinstance(output, str) or not output:
+                raise ValueError(
+                    "Profile '{}' has invalid output {!r}. Use a file path.".format(name, output)
+                )
+            if name in names:
+                raise ValueError("Profile name '{}' is used more than once.".format(name))
+            if os.path.abspath(output) in outputs:
+                raise ValueError(
+                    "Profile '{}' writes to '{}', like another profile.".format(name, output)
+                )
+            names.add(name)
+            outputs.add(os.path.abspath(output))
+
+            for key in ("attributes", "tags"):
+                value = item.get(key, [])
+                if not isinstance(value, str) and not (
+                    isinstance(value, list) and all(isinstance(x, str) for x in value)
+                ):
+                    raise ValueError(
+                        "Profile '{}' has invalid {} {!r}. Use a string, or a list "
+                        "of strings.".format(name, key, value)
+                    )
 
-        # Create local references to the parser data
-        self.config = parser.config
-        self.options = parser.options
+            static = item.get("static", {})
+            if isinstance(static, list):
+                static = saltargs.parse_input(static, False)[1]
+            if not isinstance(static, dict):
+                raise ValueError(
+                    "Profile '{}' static attributes must be a mapping.".format(name)
+                )
 
-        # Generate resources
-        self._generate()
+            profiles.append(
+                {
+                    "name": name,
+                    "output": output,
+                    "tgt": tgt,
+                    "tgt_type": tgt_type,
+                    "attributes": [
+                        x
+                        for x in cls.split_values(item.get("attributes", []))
+                        if x not in cls.ignore_attributes
+                    ],
+                    "tags": list(cls.split_values(item.get("tags", []))),
+                    "static": static,
+                }
+            )
+        return profiles
 
-    def as_dict(self):
+
+class ResourceCache:
+    """
+    Store rendered resource documents on disk, keyed by the options
+    that determine their content.
+    """
+
+    _suffix = ".out"
+    _refresh_timeout = 600
+
+    def __init__(self, cache_dir, key):
+        self.cache_dir = cache_dir
+        self.key = key
+        self.path = os.path.join(cache_dir, key + self._suffix)
+        self._nodes_path = self.path + ".json"
+        self._refresh_marker = os.path.join(cache_dir, key + ".refresh")
+
+    @staticmethod
+    def make_key(**kwargs):
         """
-        Return the generated resources as a Python dictionary
+        Build a cache key from the values that affect the generated output.
+        Sets are sorted so that equivalent invocations share a key.
         """
-        return self.resources
+        normalized = {
+            k: sorted(v) if isinstance(v, (set, list, tuple)) else v
+            for k, v in kwargs.items()
+        }
+        blob = json.dumps(normalized, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
 
-    def as_yaml(self):
+    @classmethod
+    def from_alias(cls, cache_dir, argv):
         """
-        Return the generated resources as YAML
+        Return the cache entry last generated for these command arguments,
+        or None if there is no such entry
         """
-        return self._dump_yaml(self.resources)
+        try:
+            with open(cls._alias_path(cache_dir, argv), "r", encoding="utf-8") as stream:
+                key = stream.read().strip()
+        except OSError:
+            return None
+        return cls(cache_dir, key) if key else None
 
     @staticmethod
-    def _dump_yaml(resources):
-        return yaml.safe_dump(resources, default_flow_style=False)
+    def _alias_path(cache_dir, argv):
+        """
+        Return the path of the file that maps command arguments to a cache key
+        """
+        args = [arg for arg in argv if arg != "--cache-refresh"]
+        digest = hashlib.sha256(json.dumps(args).encode("utf-8")).hexdigest()
+        return os.path.join(cache_dir, "argv-" + digest)
 
-    def _generate(self):
+    def write_alias(self, argv):
         """
-        The main function for SaltGenResource. This method calls the Salt Mine
-        and converts the returned data into a dictionary that conforms to the
-        Rundeck specification for an external resource generator.
+        Record this entry as the one generated for these command arguments,
+        so that later invocations can find it without parsing them
+        """
+        try:
+            _atomic_write(self._alias_path(self.cache_dir, argv), self.key)
+        except OSError as exc:
+            LOG.debug("Unable to write resource cache alias: %s", exc)
 
-        The return is a Python dictionary. The caller is responsible for converting
-        the dictionary into YAML for consumption by Rundeck.
+    def lookup(self, ttl, stale_ttl, args):
         """
+        Return the cached document if it is fresh, or if it is stale but
+        may be served while a background process refreshes it.
+        Otherwise, return None.
+        """
+        age = self.age()
+        if age is None or age > max(ttl, stale_ttl):
+            return None
 
-        # Create a Salt Caller object
-        caller = salt.client.Caller(c_path=None, mopts=self.config)
+        content = self.read()
+        if content is None:
+            return None
 
-        # Account for an API change in Salt Nitrogen (2017.7)
-        kwargs = {"exclude_minion": self.options.include_server_node}
-        if version.__saltstack_version__ >= version.SaltStackVersion.from_name(
-            "Nitrogen"
-        ):
-            kwargs["tgt_type"] = self.config["selected_target_option"]
+        if age <= ttl:
+            LOG.debug("Using resource cache '%s' (age %.1fs)", self.path, age)
         else:
-            kwargs["expr_form"] = self.config["selected_target_option"]
+            LOG.debug("Using stale resource cache '%s' (age %.1fs)", self.path, age)
+            self.start_refresh(args)
+        return content
 
-        # Call Salt Mine to retrieve grains for all nodes
-        LOG.debug(
-            "Calling %s with target: '%s' type: '%s'",
-            self._mine_func,
-            self.config["tgt"],
-            self.config["selected_target_option"],
-        )
-        mine = caller.cmd(
-            self._mine_func, self.config["tgt"], self.options.mine_function, **kwargs
-        )
-        LOG.debug(
+    def age(self):
+        """
+        Return the age of the cached document in seconds,
+        or None if it does not exist
+        """
+        try:
+            return max(0.0, time.time() - os.stat(self.path).st_mtime)
+        except OSError:
+            return None
+
+    def read(self):
+        """
+        Return the cached document, or None if it cannot be read
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as stream:
+                return stream.read()
+        except OSError as exc:
+            LOG.debug("Unable to read resource cache '%s': %s", self.path, exc)
+            return None
+
+    def nodes(self):
+        """
+        Return the number of nodes in the cached document,
+        or None if it is not known
+        """
+        try:
+            with open(self._nodes_path, "r", encoding="utf-8") as stream:
+                return json.load(stream)["nodes"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def write(self, content, nodes=None):
+        """
+        Atomically replace the cached document, and its number of nodes
+        if given
+        """
+        try:
+            _atomic_write(self.path, content)
+            if nodes is not None:
+                _atomic_write(self._nodes_path, json.dumps({"nodes": nodes}))
+        except OSError as exc:
+            LOG.warning("Unable to write resource cache '%s': %s", self.path, exc)
+
+    def start_refresh(self, args):
+        """
+        Regenerate the cached document in a detached background process.
+        Only one refresh process is started at a time for each key.
+        """
+        try:
+            # Discard the marker of a refresh process that never finished
+            if time.time() - os.stat(self._refresh_marker).st_mtime > self._refresh_timeout:
+                self.finish_refresh()
+        except OSError:
+            pass
+
+        try:
+            os.close(os.open(self._refresh_marker, os.O_CREAT | os.O_EXCL, 0o600))
+        except FileExistsError:
+            LOG.debug("Resource cache refresh is already running")
+            return
+        except OSError as exc:
+            LOG.warning("Unable to start resource cache refresh: %s", exc)
+            return
+
+        LOG.debug("Starting background refresh of resource cache '%s'", self.path)
+        # pylint: disable=consider-using-with,import-outside-toplevel
+        import subprocess
+
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)]
+            + list(args)
+            + ["--cache-refresh"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+            start_new_session=True,
+        )
+
+    def finish_refresh(self):
+        """
+        Release the marker created by start_refresh
+        """
+        try:
+            os.unlink(self._refresh_marker)
+        except FileNotFoundError:
+            pass
+
+
+class LastGoodOutput(ResourceCache):
+    """
+    Store the last document generated successfully for a set of options,
+    with its number of nodes, to be printed when a new one cannot be
+    generated
+    """
+
+    _suffix = ".last"
+
+    def save(self, content, nodes):
+        """
+        Atomically replace the stored document and its number of nodes
+        """
+        try:
+            _atomic_write(self.path, content)
+            _atomic_write(self._nodes_path, json.dumps({"nodes": nodes}))
+        except OSError as exc:
+            LOG.warning("Unable to store the last good output '%s': %s", self.path, exc)
+
+
+class SingleFlight(ResourceCache):
+    """
+    Let one of several concurrent invocations with the same options generate
+    a document, while the others wait for it and reuse it
+    """
+
+    _suffix = ".flight"
+    _poll_interval = 0.05
+
+    def __init__(self, cache_dir, key):
+        super().__init__(cache_dir, key)
+        self._lock_path = os.path.join(cache_dir, key + ".lock")
+        self._lock = None
+
+    def join(self, timeout):
+        """
+        Wait up to timeout seconds for the lock of this key. Return the
+        document stored by the invocation that held it meanwhile, or None
+        if this invocation holds the lock and must generate the document,
+        gave up waiting, or could not take the lock at all.
+        """
+        previous = self._signature()
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            lock = os.open(self._lock_path, os.O_CREAT | os.O_RDWR, 0o600)
+        except OSError as exc:
+            LOG.warning("Not waiting for concurrent runs, unable to open '%s': %s", self._lock_path, exc)
+            return None
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    os.close(lock)
+                    LOG.warning(
+                        "Gave up waiting %g seconds for a concurrent run with the same options",
+                        timeout,
+                    )
+                    return None
+                time.sleep(self._poll_interval)
+            except OSError as exc:
+                os.close(lock)
+                LOG.warning("Not waiting for concurrent runs, unable to lock '%s': %s", self._lock_path, exc)
+                return None
+        self._lock = lock
+
+        # Documents are replaced atomically, so a new one has a new inode
+        current = self._signature()
+        if current is None or current == previous:
+            return None
+        content = self.read()
+        if content is not None:
+            LOG.debug("Reusing the output of a concurrent run '%s'", self.path)
+            self.release()
+        return content
+
+    def release(self):
+        """
+        Release the lock taken by join, letting waiting invocations continue
+        """
+        if self._lock is not None:
+            os.close(self._lock)
+            self._lock = None
+
+    def _signature(self):
+        """
+        Return the identity of the stored document, or None if there is none
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+class ConfigCache:
+    """
+    Store the resolved minion configuration, to be reused while the
+    configuration file, its includes and the cached minion ID are unchanged
+    """
+
+    def __init__(self, cache_dir, config_path):
+        self.config_path = config_path
+        # The environment can select another configuration file
+        key = [config_path] + [
+            os.environ.get(name) for name in ("SALT_MINION_CONFIG", "SALT_CONFIG_DIR")
+        ]
+        digest = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+        self.path = os.path.join(cache_dir, "config-" + digest)
+
+    def load(self):
+        """
+        Return the stored configuration, or None if there is none,
+        or if it is stale
+        """
+        import pickle  # pylint: disable=import-outside-toplevel
+
+        try:
+            with open(self.path, "rb") as stream:
+                stat = os.fstat(stream.fileno())
+                # Only unpickle files that no other user can have written
+                if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+                    LOG.warning("Ignoring unsafe configuration cache '%s'", self.path)
+                    return None
+                snapshot = pickle.load(stream)
+        except FileNotFoundError:
+            return None
+        except Exception as exc:  # pylint: disable=broad-except
+            LOG.debug("Unable to read configuration cache '%s': %s", self.path, exc)
+            return None
+
+        current = (version.__version__, sys.version)
+        if snapshot["version"] != current or snapshot["files"] != self._files(snapshot["config"]):
+            LOG.debug("Configuration cache '%s' is stale", self.path)
+            return None
+        LOG.debug("Using configuration cache '%s'", self.path)
+        return snapshot["config"]
+
+    def save(self, config_opts):
+        """
+        Atomically replace the stored configuration
+        """
+        import pickle  # pylint: disable=import-outside-toplevel
+
+        snapshot = {
+            "version": (version.__version__, sys.version),
+            "files": self._files(config_opts),
+            "config": config_opts,
+        }
+        try:
+            _atomic_write(self.path, pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL))
+        except (OSError, pickle.PicklingError, TypeError) as exc:
+            LOG.debug("Unable to write configuration cache '%s': %s", self.path, exc)
+
+    def _files(self, config_opts):
+        """
+        Return the modification time and size of every file that the
+        configuration was read from, or could be read from
+        """
+        directory = os.path.dirname(self.config_path)
+        paths = [
+            self.config_path,
+            config_opts.get("conf_file") or self.config_path,
+            os.path.join(directory, "minion_id"),
+        ]
+        for key in ("default_include", "include"):
+            patterns = config_opts.get(key) or []
+            if isinstance(patterns, str):
+                patterns = [patterns]
+            # Resolved like the includes of salt.config.include_config
+            for pattern in patterns:
+                pattern = os.path.join(directory, os.path.expanduser(pattern))
+                paths.extend(sorted(glob.glob(pattern)))
+
+        files = []
+        for name in paths:
+            try:
+                stat = os.stat(name)
+                files.append((name, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                files.append((name, None, None))
+        return files
+
+
+def _atomic_write(path, content, mode=0o600):
+    """
+    Write text or bytes to a temporary file beside path, then rename it
+    into place
+    """
+    directory = os.path.dirname(path) or "."
+    # Missing directories are searchable by whoever may read the file
+    os.makedirs(directory, mode=mode | (mode & 0o444) >> 2, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        if isinstance(content, bytes):
+            stream = os.fdopen(fd, "wb")
+        else:
+            stream = os.fdopen(fd, "w", encoding="utf-8")
+        with stream:
+            stream.write(content)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _write_if_changed(path, write, mode=0o644):
+    """
+    Call write with a stream on a temporary file beside path, and rename it
+    into place only if its content differs from the existing file, so that
+    the modification time of path changes only with its content.
+
+    Returns True if the file was replaced.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, mode=mode | (mode & 0o444) >> 2, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as stream:
+            write(stream)
+        # Compares the sizes first, and the contents only if they match
+        changed = not (os.path.isfile(path) and filecmp.cmp(tmp_path, path, shallow=False))
+        if changed:
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, path)
+        else:
+            os.unlink(tmp_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return changed
+
+
+def _write_output_file(path, write):
+    """
+    Write the resources to an --output-file with _write_if_changed, and log
+    the result. Returns whether the file was replaced, or None if it could
+    not be written.
+    """
+    try:
+        changed = _write_if_changed(path, write)
+    except OSError as exc:
+        LOG.error("Unable to write the resources to '%s': %s", path, exc)
+        return None
+    if changed:
+        LOG.info("Wrote the resources to '%s'", path)
+    else:
+        LOG.info("The resources in '%s' are unchanged", path)
+    return changed
+
+
+# Target types that _match_target() can evaluate from mine data,
+# with their prefixes in compound target expressions
+_COMPOUND_PREFIXES = {
+    "glob": "",
+    "pcre": "E@",
+    "list": "L@",
+    "grain": "G@",
+    "grain_pcre": "P@",
+    "ipcidr": "S@",
+}
+
+
+def _match_target(minion, grains, tgt, tgt_type, delimiter=":"):
+    """
+    Evaluate a target expression locally against one minion, using the
+    grains returned for it by the Salt Mine. This follows the behavior
+    of the Salt matchers for the target types in _COMPOUND_PREFIXES.
+    """
+    if tgt_type == "glob":
+        return fnmatch.fnmatch(minion, tgt)
+    if tgt_type == "pcre":
+        return re.match(tgt, minion) is not None
+    if tgt_type == "list":
+        if isinstance(tgt, str):
+            tgt = tgt.split(",")
+        return minion in tgt
+    if tgt_type in ("grain", "grain_pcre"):
+        return datautils.subdict_match(
+            grains, tgt, delimiter=delimiter, regex_match=tgt_type == "grain_pcre"
+        )
+    if tgt_type == "ipcidr":
+        import ipaddress  # pylint: disable=import-outside-toplevel
+
+        try:
+            network = ipaddress.ip_network(tgt, strict=False)
+        except ValueError:
+            LOG.error("Invalid IP/CIDR target: %s", tgt)
+            return False
+        for address in grains.get("ipv{}".format(network.version)) or []:
+            try:
+                if ipaddress.ip_address(address) in network:
+                    return True
+            except ValueError:
+                continue
+        return False
+    raise ValueError("Target type '{}' cannot be matched locally".format(tgt_type))
+
+
+# Keys of mine entries that carry a minion-side access control list
+_MINE_ACL_ID = "__saltmine_acl__"
+_MINE_ACL_DATA = "__data__"
+
+
+def _load_payload(path):
+    """
+    Load a file of the Salt localfs cache, or return None if it is missing
+    or cannot be read
+    """
+    try:
+        with open(path, "rb") as stream:
+            return salt.payload.load(stream)
+    except FileNotFoundError:
+        return None
+    except Exception as exc:  # pylint: disable=broad-except
+        LOG.warning("Unable to read Salt cache file '%s': %s", path, exc)
+        return None
+
+
+def _read_master_cache(
+    cachedir, function, tgt, tgt_type, delimiter=":", exclude=None, requester=None
+):
+    """
+    Read the Salt Mine data of a function for all minions that match a target
+    directly from the localfs cache of a Salt Master, without a request to
+    the master. Minions are matched locally, as in _match_target(), using the
+    grains cached by the master when available.
+
+    Like the Salt Master, data stored with a minion-side ACL (allow_tgt) is
+    only returned if the requester, the ID of the local minion, matches it.
+
+    Both the layout of Salt 3008 and later (mine/<id>.p, grains/<id>.p)
+    and the older layout (minions/<id>/mine.p, minions/<id>/data.p)
+    are supported.
+    """
+    if os.path.isdir(os.path.join(cachedir, "mine")):
+
+        def paths(minion):
+            return (
+                os.path.join(cachedir, "mine", minion + ".p"),
+                os.path.join(cachedir, "grains", minion + ".p"),
+            )
+
+        minions = [
+            name[:-2]
+            for name in os.listdir(os.path.join(cachedir, "mine"))
+            if name.endswith(".p")
+        ]
+    elif os.path.isdir(os.path.join(cachedir, "minions")):
+
+        def paths(minion):
+            return (
+                os.path.join(cachedir, "minions", minion, "mine.p"),
+                os.path.join(cachedir, "minions", minion, "data.p"),
+            )
+
+        minions = os.listdir(os.path.join(cachedir, "minions"))
+    else:
+        LOG.error("No Salt Mine data found in the Salt Master cache: %s", cachedir)
+        return {}
+
+    requester_grains = []
+
+    def allowed(entry):
+        # Evaluate the ACL like salt.daemons.masterapi, which refuses
+        # requesters not matched by allow_tgt
+        if requester is None:
+            return False
+        if not requester_grains:
+            cached = _load_payload(paths(requester)[1])
+            requester_grains.append(
+                cached.get("grains", cached) if isinstance(cached, dict) else {}
+            )
+        try:
+            return _match_target(
+                requester,
+                requester_grains[0],
+                entry["allow_tgt"],
+                entry.get("allow_tgt_type", "glob"),
+                delimiter,
+            )
+        except ValueError as exc:
+            LOG.debug("Unable to evaluate the Salt Mine ACL: %s", exc)
+            return False
+
+    mine = {}
+    for minion in sorted(minions):
+        if minion == exclude:
+            continue
+        mine_path, grains_path = paths(minion)
+        data = _load_payload(mine_path)
+        if not isinstance(data, dict) or function not in data:
+            continue
+        value = data[function]
+        if isinstance(value, dict) and _MINE_ACL_ID in value:
+            if "allow_tgt" in value and not allowed(value):
+                LOG.debug("Salt Mine ACL of minion '%s' denies access", minion)
+                continue
+            value = value[_MINE_ACL_DATA]
+
+        grains = value
+        if tgt_type in ("grain", "grain_pcre"):
+            cached = _load_payload(grains_path)
+            if isinstance(cached, dict):
+                grains = cached.get("grains", cached)
+        if _match_target(minion, grains, tgt, tgt_type, delimiter):
+            mine[minion] = value
+    return mine
+
+
+class CallerBackend:
+    """
+    Fetch Salt Mine data with mine.get, called through the local minion
+    """
+
+    _mine_func = "mine.get"
+
+    # Whether several targets may be fetched at the same time
+    concurrent = False
+    # Whether targets are matched here, rather than by the Salt Master,
+    # so that only the target types in _COMPOUND_PREFIXES are supported
+    matches_locally = False
+
+    def __init__(self, opts, options):
+        self.config = opts
+        self.options = options
+        self._caller = None
+        self._lock = threading.Lock()
+        # The Caller and its minion are not thread-safe
+        self._call_lock = threading.Lock()
+
+    def _get_caller(self):
+        # Create a Salt Caller object, or reuse the one from a previous call
+        with self._lock:
+            if self._caller is None:
+                self._caller = salt.client.Caller(c_path=None, mopts=self.config)
+        return self._caller
+
+    def mine(self, tgt, tgt_type):
+        """
+        Return the Salt Mine data of every minion matching a target
+        """
+        # Account for an API change in Salt Nitrogen (2017.7)
+        kwargs = {"exclude_minion": self.options.include_server_node}
+        if version.__saltstack_version__ >= version.SaltStackVersion.from_name(
+            "Nitrogen"
+        ):
+            kwargs["tgt_type"] = tgt_type
+        else:
+            kwargs["expr_form"] = tgt_type
+
+        with self._call_lock:
+            return self._get_caller().cmd(
+                self._mine_func, tgt, self.options.mine_function, **kwargs
+            )
+
+    def grains(self, keys=None):  # pylint: disable=unused-argument
+        """
+        Return the grains of the local minion. Backends may leave out
+        grains that are not in keys.
+        """
+        with self._call_lock:
+            return self._get_caller().sminion.opts["grains"]
+
+
+class TransportBackend(CallerBackend):
+    """
+    Send mine.get requests straight to the Salt Master over its request
+    channel, authenticated with the keys of the local minion. Unlike the
+    Caller, this does not load the execution modules, grains and pillar
+    of the minion first.
+    """
+
+    # Every call opens its own request channel
+    concurrent = True
+
+    def __init__(self, opts, options):
+        super().__init__(opts, options)
+        self._opts = None
+        self._grains = None
+
+    def _get_opts(self):
+        # Resolve the address of the Salt Master once, like a starting minion.
+        # With several masters, the first one is used.
+        from salt.minion import resolve_dns  # pylint: disable=import-outside-toplevel
+
+        with self._lock:
+            if self._opts is None:
+                opts = dict(self.config)
+                if isinstance(opts["master"], list):
+                    opts["master"] = opts["master"][0]
+                opts.update(resolve_dns(opts))
+                self._opts = opts
+        return self._opts
+
+    def mine(self, tgt, tgt_type):
+        """
+        Return the Salt Mine data of every minion matching a target
+        """
+        # pylint: disable=import-outside-toplevel
+        from salt.crypt import SAuth
+
+        try:
+            from salt.channel.client import ReqChannel
+        except ImportError:
+            # Salt releases before 3005
+            from salt.transport.client import ReqChannel
+
+        opts = self._get_opts()
+        load = {
+            "cmd": "_mine_get",
+            "id": opts["id"],
+            "tgt": tgt,
+            "fun": self.options.mine_function,
+        }
+        # Account for an API change in Salt Nitrogen (2017.7)
+        if version.__saltstack_version__ >= version.SaltStackVersion.from_name(
+            "Nitrogen"
+        ):
+            load["tgt_type"] = tgt_type
+        else:
+            load["expr_form"] = tgt_type
+
+        # Salt Masters before 3005 only answer requests with a signed token
+        load["tok"] = SAuth(opts).gen_token(b"salt")
+        with ReqChannel.factory(opts) as channel:
+            mine = channel.send(load)
+
+        if self.options.include_server_node:
+            mine.pop(opts["id"], None)
+        return mine
+
+    def grains(self, keys=None):
+        """
+        Return the grains of the local minion. The grains of every server
+        node are read from the platform module, along with the static grains
+        of the minion configuration. The grain modules are only loaded
+        when other grains are needed.
+        """
+        grains = {
+            "kernel": platform.system(),
+            "kernelrelease": platform.release(),
+            "cpuarch": platform.machine(),
+        }
+        grains.update(self.config.get("grains") or {})
+        if keys is None or not set(keys).issubset(grains):
+            if self._grains is None:
+                self._grains = salt.loader.grains(self.config)
+            grains = self._grains
+        return grains
+
+
+class _LocalBackend:
+    """
+    Base class of backends that match targets locally, and read the
+    grains of the local minion without connecting to the Salt Master
+    """
+
+    concurrent = True
+    matches_locally = True
+
+    def __init__(self, opts, options):
+        self.config = opts
+        self.options = options
+        self._grains = None
+
+    def _exclude(self):
+        # Exclude the local minion, like mine.get through the Caller
+        if self.options.include_server_node:
+            return self.config.get("id")
+        return None
+
+    def _match(self, data, tgt, tgt_type):
+        exclude = self._exclude()
+        return {
+            minion: grains
+            for minion, grains in data.items()
+            if minion != exclude
+            and _match_target(minion, grains, tgt, tgt_type, self.options.delimiter)
+        }
+
+    def grains(self, keys=None):  # pylint: disable=unused-argument
+        """
+        Return the grains of the local minion
+        """
+        if self._grains is None:
+            self._grains = salt.loader.grains(self.config)
+        return self._grains
+
+
+class MasterCacheBackend(_LocalBackend):
+    """
+    Read Salt Mine data from the cache of a Salt Master on this host
+    """
+
+    def mine(self, tgt, tgt_type):
+        """
+        Return the Salt Mine data of every minion matching a target
+        """
+        return _read_master_cache(
+            self.options.master_cache_dir,
+            self.options.mine_function,
+            tgt,
+            tgt_type,
+            self.options.delimiter,
+            exclude=self._exclude(),
+            requester=self.config.get("id"),
+        )
+
+
+class FixtureBackend(_LocalBackend):
+    """
+    Read Salt Mine data from a file in the format returned by mine.get:
+    a mapping of minion IDs to their data, as YAML, JSON or msgpack
+    """
+
+    def __init__(self, opts, options):
+        super().__init__(opts, options)
+        self._data = None
+
+    def _load(self):
+        path = self.options.fixture_file
+        if path.endswith(".json"):
+            with open(path, "r", encoding="utf-8") as stream:
+                return json.load(stream)
+        if path.endswith((".p", ".msgpack", ".mpk")):
+            with open(path, "rb") as stream:
+                return salt.payload.load(stream)
+        with open(path, "r", encoding="utf-8") as stream:
+            return yaml.load(stream, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+    def mine(self, tgt, tgt_type):
+        """
+        Return the Salt Mine data of every minion matching a target
+        """
+        if self._data is None:
+            self._data = self._load() or {}
+        return self._match(self._data, tgt, tgt_type)
+
+
+class SyntheticBackend(_LocalBackend):
+    """
+    Fabricate Salt Mine data for a number of minions, with grains shaped
+    like those returned by grains.items, to measure the conversion of
+    large fleets without a Salt Master
+    """
+
+    _roles = ["web", "db", "cache", "queue", "batch", "proxy", "monitoring"]
+
+    def __init__(self, opts, options):
+        super().__init__(opts, options)
+        self._data = None
+
+    @classmethod
+    def minions(cls, count, seed=0):
+        """
+        Return fabricated grains for count minions. The same seed always
+        returns the same grains.
+        """
+        rand = random.Random(seed)
+        mine = {}
+        for index in range(count):
+            windows = rand.random() < 0.1
+            name = "minion{:06d}".format(index)
+            mine[name] = {
+                "id": name,
+                "fqdn": name + ".example.com",
+                "kernel": "Windows" if windows else "Linux",
+                "kernelrelease": "6.3.9600"
+                if windows
+                else "4.18.0-{}.el8.x86_64".format(rand.randint(100, 500)),
+                "cpuarch": "AMD64" if windows else "x86_64",
+                "cpu_model": "Intel(R) Xeon(R) Gold 6{}R CPU @ 3.00GHz".format(
+                    rand.randint(100, 299)
+                ),
+                "kernelversion": "Microsoft Windows Server 2012 R2 Standard"
+                if windows
+                else "#1 SMP PREEMPT_DYNAMIC Thu Mar {} 12:00:00 UTC 2023".format(
+                    rand.randint(1, 31)
+                ),
+                "os": "Windows"
+                if windows
+                else rand.choice(["CentOS", "Ubuntu", "Debian"]),
+                "os_family": "Windows"
+                if windows
+                else rand.choice(["RedHat", "Debian"]),
+                "osrelease": "{}.{}".format(rand.randint(6, 9), rand.randint(0, 9)),
+                "virtual": rand.choice(["kvm", "VMware", "physical"]),
+                "num_cpus": rand.choice([2, 4, 8, 16]),
+                "mem_total": rand.choice([2048, 4096, 8192, 16384]),
+                "roles": rand.sample(cls._roles, rand.randint(1, 3)),
+                "ipv4": [
+                    "127.0.0.1",
+                    "10.{}.{}.{}".format(index >> 16 & 255, index >> 8 & 255, index & 255),
+                ],
+                "ip_interfaces": {
+                    "lo": ["127.0.0.1"],
+                    "eth0": ["10.0.{}.{}".format(index >> 8 & 255, index & 255)],
+                },
+                "locale_info": {"defaultlanguage": "en_US", "defaultencoding": "UTF-8"},
+                "instruments": [["oboe", "tuba"], ["violin", "cello"]],
+                "cpu_flags": ["fpu", "vme", "de", "pse", "tsc", "msr", "pae", "mce"] * 8,
+                "pythonpath": [
+                    "/usr/lib/python3.{}/site-packages".format(n) for n in range(8)
+                ],
+                "saltversion": "3006.{}".format(rand.randint(0, 9)),
+            }
+        return mine
+
+    def mine(self, tgt, tgt_type):
+        """
+        Return the Salt Mine data of every minion matching a target
+        """
+        if self._data is None:
+            self._data = self.minions(self.options.synthetic_count)
+        return self._match(self._data, tgt, tgt_type)
+
+
+# Backends selected with --backend
+BACKENDS = {
+    "caller": CallerBackend,
+    "transport": TransportBackend,
+    "master-cache": MasterCacheBackend,
+    "fixture": FixtureBackend,
+    "synthetic": SyntheticBackend,
+}
+
+
+def _target_grains(tgt, tgt_type, delimiter=":"):
+    """
+    Return the top-level grains that _match_target() needs to evaluate
+    a target expression
+    """
+    if tgt_type in ("grain", "grain_pcre"):
+        return {tgt.split(delimiter)[0]}
+    if tgt_type == "ipcidr":
+        return {"ipv4", "ipv6"}
+    return set()
+
+
+def _encoded_size(value):
+    """
+    Return the length of a value encoded as JSON, as an estimate of
+    its size when transferred
+    """
+    return len(json.dumps(value, separators=(",", ":"), default=repr))
+
+
+class _NodeRecord(collections.abc.Mapping):
+    """
+    A read-only node definition that takes less memory than a dictionary.
+    Nodes with the same attribute names share one index of names, and
+    list values such as tags are kept as tuples. Lists are returned when
+    values are read, so a record compares equal to the dictionary it was
+    made from.
+    """
+
+    __slots__ = ("_index", "_values")
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, key):
+        value = self._values[self._index[key]]
+        return list(value) if isinstance(value, tuple) else value
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return "_NodeRecord({!r})".format(self.expand())
+
+    def expand(self):
+        """
+        Return the node definition as a dictionary
+        """
+        return {key: self[key] for key in self._index}
+
+
+class _NodeTable:
+    """
+    Make node records that share their attribute names and string
+    values with the other records made by the same table
+    """
+
+    def __init__(self):
+        self._indexes = {}
+        self._strings = {}
+
+    def compact(self, node):
+        """
+        Return a node definition as a node record
+        """
+        if isinstance(node, _NodeRecord):
+            return node
+        setdefault = self._strings.setdefault
+        names = tuple(node)
+        index = self._indexes.get(names)
+        if index is None:
+            index = self._indexes[names] = {
+                setdefault(name, name): position for position, name in enumerate(names)
+            }
+        values = []
+        for value in node.values():
+            if isinstance(value, list):
+                # Lists of strings, such as tags, are shared with their strings.
+                # Other lists, such as nested static values, are kept as they are.
+                if all(isinstance(item, str) for item in value):
+                    value = tuple(map(setdefault, value, value))
+                    value = setdefault(value, value)
+            elif isinstance(value, str):
+                value = setdefault(value, value)
+            values.append(value)
+        return _NodeRecord(index, tuple(values))
+
+
+def _canonical_value(value):
+    """
+    Render a node attribute value or tag as a normalized string. Values
+    other than strings are written as JSON, with their keys sorted.
+    """
+    if isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return unicodedata.normalize("NFC", value)
+
+
+def _canonical_node(node):
+    """
+    Return a node definition with its attributes in name order, its values
+    as normalized strings, and its tags sorted
+    """
+    if isinstance(node, _NodeRecord):
+        # Reused by incremental generation from the nodes of a previous run
+        # in this process, which are stored compacted
+        node = node.expand()
+    canonical = {}
+    for key in sorted(node):
+        if key == "tags":
+            canonical[key] = sorted({_canonical_value(tag) for tag in node[key]})
+        else:
+            canonical[key] = _canonical_value(node[key])
+    return canonical
+
+
+def _json_default(value):
+    """
+    Encode node records in JSON documents as objects
+    """
+    if isinstance(value, _NodeRecord):
+        return value.expand()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+# Strings that YAML loads as strings when written without quotes
+_YAML_PLAIN = re.compile(r"^[A-Za-z_][A-Za-z0-9_./-]*$")
+_YAML_RESERVED = {"yes", "no", "true", "false", "on", "off", "null"}
+
+
+def _yaml_scalar(value):
+    """
+    Render a scalar value as YAML, or return None if the value is of a
+    type that _emit_node() leaves to PyYAML
+    """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, str) and value.isascii():
+        if _YAML_PLAIN.match(value) and value.lower() not in _YAML_RESERVED:
+            return value
+        # A JSON string is a valid YAML double-quoted scalar
+        return json.dumps(value)
+    return None
+
+
+def _emit_node(name, node):
+    """
+    Render one node definition as a YAML mapping entry without PyYAML.
+    Node definitions have a known, flat shape, so only scalars and lists
+    of scalars need to be handled. Returns None for anything else.
+    """
+    key = _yaml_scalar(name) if isinstance(name, str) else None
+    if key is None:
+        return None
+
+    lines = [key + ":"]
+    for attribute in sorted(node):
+        value = node[attribute]
+        attribute_key = _yaml_scalar(attribute) if isinstance(attribute, str) else None
+        if attribute_key is None:
+            return None
+        if isinstance(value, list) and value:
+            lines.append("  {}:".format(attribute_key))
+            for item in value:
+                item = _yaml_scalar(item)
+                if item is None:
+                    return None
+                lines.append("  - " + item)
+        else:
+            rendered = _yaml_scalar(value)
+            if rendered is None:
+                return None
+            lines.append("  {}: {}".format(attribute_key, rendered))
+    return "\n".join(lines) + "\n"
+
+
+def _dump_node(name, node, dumper):
+    """
+    Render one node definition as a YAML mapping entry, using the given
+    PyYAML dumper class, or the hand-rolled emitter if it is None
+    """
+    if dumper is None:
+        text = _emit_node(name, node)
+        if text is not None:
+            return text
+        dumper = yaml.SafeDumper
+    if isinstance(node, _NodeRecord):
+        node = node.expand()
+    return yaml.dump({name: node}, Dumper=dumper, default_flow_style=False)
+
+
+# Node attributes written as attributes of the node element in resource XML.
+# All others are written as attribute elements.
+_XML_NODE_ATTRIBUTES = (
+    "description",
+    "hostname",
+    "osArch",
+    "osFamily",
+    "osName",
+    "osVersion",
+    "username",
+)
+_XML_INVALID = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _xml_value(value):
+    """
+    Render a node attribute value as XML attribute text
+    """
+    if isinstance(value, bool):
+        value = "true" if value else "false"
+    elif isinstance(value, bytes):
+        value = value.decode("utf-8", "replace")
+    return saxutils.quoteattr(_XML_INVALID.sub("", str(value)))
+
+
+def _xml_node(name, node):
+    """
+    Render one node definition as a resource XML node element
+    """
+    attributes = [("name", name)]
+    children = []
+    for key in sorted(node):
+        if key == "tags":
+            attributes.append((key, ",".join(str(tag) for tag in node[key])))
+        elif key in _XML_NODE_ATTRIBUTES:
+            attributes.append((key, node[key]))
+        else:
+            children.append(
+                "    <attribute name={} value={}/>\n".format(
+                    _xml_value(key), _xml_value(node[key])
+                )
+            )
+
+    element = "  <node" + "".join(
+        " {}={}".format(key, _xml_value(value)) for key, value in attributes
+    )
+    if not children:
+        return element + "/>\n"
+    return element + ">\n" + "".join(children) + "  </node>\n"
+
+
+def _dump_json(value):
+    """
+    Encode a value as compact JSON with sorted keys, like YAML output.
+    orjson is used when it is installed.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                value, default=_json_default, option=orjson.OPT_SORT_KEYS
+            ).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(value, separators=(",", ":"), sort_keys=True, default=_json_default)
+
+
+def _load_document(text, output_format):
+    """
+    Parse a resource document in one of the output formats back into
+    a dictionary of node definitions
+    """
+    if output_format == "json":
+        return json.loads(text)
+    if output_format == "xml":
+        resources = {}
+        for element in ElementTree.fromstring(text).iter("node"):
+            node = dict(element.attrib)
+            name = node.pop("name")
+            if "tags" in node:
+                node["tags"] = [tag for tag in node["tags"].split(",") if tag]
+            for attribute in element.iter("attribute"):
+                node[attribute.get("name")] = attribute.get("value")
+            resources[name] = node
+        return resources
+    return yaml.safe_load(text) or {}
+
+
+def _list_index(key):
+    """
+    Return a key of a grain path as a list index, or None if it is not
+    one. Like Salt, accept anything int() does, such as "+1" but not "²".
+    """
+    try:
+        return int(key)
+    except ValueError:
+        return None
+
+
+def _grain_lookup(item, delimiter, default):
+    """
+    Return a function that looks up a grain by its delimited key path.
+    The function returns the same value as salt.utils.data.traverse_dict_and_list,
+    but walks nested dicts and lists directly when it can.
+    """
+    path = [(key, _list_index(key)) for key in item.split(delimiter)]
+    keys = [key for key, _ in path]
+
+    def lookup(grains):
+        value = grains
+        try:
+            for key, index in path:
+                if isinstance(value, dict):
+                    value = value[key]
+                elif (
+                    isinstance(value, list)
+                    and index is not None
+                    and not any(isinstance(x, dict) for x in value)
+                ):
+                    value = value[index]
+                else:
+                    break
+            else:
+                return value
+        except (KeyError, IndexError):
+            pass
+        # Fall back to the full traversal rules, such as matching
+        # keys of embedded dicts and numeric dict keys
+        return datautils.traverse_dict_and_list(grains, keys, default)
+
+    return lookup
+
+
+class _ByteCounter:
+    """
+    Count and hash the bytes of text written to a stream
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+        self.digest = hashlib.sha256()
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.count += len(data)
+        self.digest.update(data)
+        return self.stream.write(text)
+
+
+class _WarningCounter(logging.Handler):
+    """
+    Count the warnings and errors logged while a stage runs
+    """
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+class _RecordBuffer(logging.Handler):
+    """
+    Keep log records in a worker process, to be handled by the parent
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # Format the message here, as its arguments may not be picklable
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+def _handled_level(logger):
+    """
+    Return the lowest level of the handlers that output the records of
+    a logger. Salt sets the level of the root logger to the lowest level
+    of all its handlers, so a level may be enabled on the logger even
+    though no handler outputs its records.
+    """
+    levels = []
+    while logger:
+        levels.extend(handler.level for handler in logger.handlers)
+        if not logger.propagate:
+            break
+        logger = logger.parent
+    return min(levels) if levels else logging.lastResort.level
+
+
+# Set in each worker process by _init_worker()
+_worker_state = None
+
+
+def _init_worker(generator, mine, names, size):
+    """
+    Prepare a worker process to convert chunks of minions
+    """
+    global _worker_state  # pylint: disable=global-statement
+    buffer = _RecordBuffer()
+
+    # Only keep records that a handler in the parent process would output
+    buffer.setLevel(_handled_level(LOG))
+
+    LOG.handlers = [buffer]
+    LOG.propagate = False
+    _worker_state = (generator, mine, names, size, buffer)
+
+
+def _convert_chunk(start):
+    """
+    Convert the chunk of minions starting at the given index, and return
+    a list of (node, log records) tuples, the changes to the counts of the
+    generator and its diagnostics
+    """
+    # pylint: disable=protected-access
+    generator, mine, names, size, buffer = _worker_state
+    counts = dict(generator._counts)
+    generator._diagnostics = {}
+    chunk = []
+    for name in names[start : start + size]:
+        node = generator._minion_node(name, mine[name])
+        chunk.append((node, buffer.records))
+        buffer.records = []
+    counts = {key: generator._counts[key] - counts[key] for key in counts}
+    return chunk, counts, generator._diagnostics
+
+
+class ResourceGenerator:
+    """
+    Provide a dictionary of node definitions.
+    When written to stdout in YAML format, this dictionary is consumable
+    by Rundeck.
+    """
+
+    # Define maps from grain values into expected strings
+    _os_family_map = {"Linux": "unix", "Windows": "windows"}
+    _os_arch_map = {"x86_64": "amd64", "AMD64": "amd64"}
+    _server_node_name = "localhost"
+    _required_grains = ("fqdn", "kernel", "kernelrelease", "cpuarch")
+    _server_required_grains = ("kernel", "kernelrelease", "cpuarch")
+    _mine_alias = "rundeck_grains"
+    _profiler = None
+
+    # Fetch threads abandoned by --fetch-timeout that are still running,
+    # shared by every generator in the process, such as a server refreshing
+    _abandoned_fetches = []
+    _abandoned_lock = threading.Lock()
+    _max_abandoned_fetches = 4
+
+    # Problems with requested grains, logged for each minion at debug level
+    _diagnostic_details = {
+        "missing": "Requested grain '%s' is not available on minion: %s",
+        "list": "Grain '%s' is a list on minion: %s. First item will be selected.",
+        "attribute_type": (
+            "Grain '%s' ignored on minion: %s because its type is unsupported."
+        ),
+        "tag_type": (
+            "Tag not added for grain: '%s' on minion: %s "
+            "because its data type is not supported."
+        ),
+    }
+    # Summaries of the problems, logged as warnings after conversion
+    _diagnostic_summaries = {
+        "missing": "Requested grain '%s' is not available on %d minion%s",
+        "list": "Grain '%s' is a list on %d minion%s. First item was selected",
+        "attribute_type": (
+            "Grain '%s' ignored on %d minion%s because its type is unsupported"
+        ),
+        "tag_type": (
+            "Tags not added for grain '%s' on %d minion%s "
+            "because its data type is not supported"
+        ),
+    }
+
+    # pylint: disable=no-member
+    def __init__(self, args=None, generate=True):
+        """
+        Parse command arguments, and generate the resources unless
+        generate is False. Without generating them here, call generate()
+        to get them.
+        """
+        self._reset_timings()
+        with self._stage("import"):
+            parser_class = _load_salt()
+
+        # Call the configuration parser
+        with self._stage("config"):
+            parser = parser_class()
+            parser.parse_args(args)
+
+        # Removing 'conf_file' prevents the file from being re-read when rendering grains
+        parser.config.pop("conf_file", None)
+
+        # Parse the static attribute definitions
+        self.static = saltargs.parse_input(parser.args, False)[1]
+
+        # Create local references to the parser data
+        self.config = parser.config
+        self.options = parser.options
+        self._debug = False
+        self._diagnostics = {}
+        self._compile_plan()
+
+        # Serve the output from the resource cache when possible
+        self.resources = {}
+        self._output = None
+        self.backend = None
+        self._mine = None
+        self._node_state = None
+        self._cached_nodes = None
+        self.stats = {}
+        if self.options.profile_file:
+            import cProfile  # pylint: disable=import-outside-toplevel
+
+            # Profiles accumulate over all conversions, including refreshes
+            self._profiler = cProfile.Profile()
+        argv = sys.argv[1:] if args is None else list(args)
+
+        # Batch profiles are generated by write_profiles()
+        if not generate or self.options.profiles or self.options.print_mine_config:
+            return
+
+        cache = self._cache()
+        if cache is not None and not self.options.cache_refresh:
+            with self._stage("cache"):
+                self._output = cache.lookup(
+                    self.options.cache_ttl, self.options.cache_stale_ttl, argv
+                )
+            if self._output is not None:
+                self.stats["cache_hit"] = True
+                self._cached_nodes = cache.nodes()
+                return
+
+        flight = self._single_flight()
+        if flight is not None:
+            waited = time.perf_counter()
+            with self._stage("cache"):
+                self._output = flight.join(self.options.single_flight)
+            self.stats["single_flight"] = {
+                "shared": self._output is not None,
+                "wait_seconds": time.perf_counter() - waited,
+            }
+            if self._output is not None:
+                return
+
+        # Generate resources
+        last_good = self._last_good()
+        try:
+            # Only a failure to fetch the Salt Mine data, or a result that lost
+            # too many nodes, is replaced by the last good output
+            try:
+                mine = self._call_targets(self._targets())
+            except Exception as exc:  # pylint: disable=broad-except
+                if last_good is None or not self._fall_back(last_good, exc):
+                    raise
+                return
+            mine = self._project(mine, self._grain_keys)
+            if self.options.stream and cache is None and last_good is None and flight is None:
+                # Nodes are converted as they are written by write()
+                self._mine = mine
+            else:
+                self._convert(mine)
+            if last_good is not None:
+                try:
+                    self._check_node_drop(last_good.nodes())
+                except ValueError as exc:
+                    if not self._fall_back(last_good, exc):
+                        raise
+                    return
+            if cache is not None or last_good is not None or flight is not None:
+                with self._stage("render"):
+                    self._output = self.render()
+            # An empty result is never worth falling back to
+            if last_good is not None and self.resources:
+                with self._stage("cache"):
+                    last_good.save(self._output, len(self.resources))
+            if cache is not None:
+                with self._stage("cache"):
+                    cache.write(self._output, len(self.resources))
+                    cache.write_alias(argv)
+            if flight is not None:
+                with self._stage("cache"):
+                    flight.write(self._output)
+        finally:
+            if cache is not None and self.options.cache_refresh:
+                cache.finish_refresh()
+            if flight is not None:
+                flight.release()
+
+    def as_dict(self):
+        """
+        Return the generated resources as a Python dictionary
+        """
+        return {name: dict(node) for name, node in self._nodes().items()}
+
+    def _nodes(self):
+        """
+        Return the generated node definitions, which are node records
+        unless they were loaded from the resource cache
+        """
+        if self._output is not None and not self.resources:
+            return _load_document(self._output, self.options.output_format)
+        if self._mine is not None and not self.resources:
+            self._convert(self._mine)
+        return self.resources
+
+    def as_yaml(self):
+        """
+        Return the generated resources as YAML
+        """
+        return self._cached_document("yaml") or self._dump_yaml(self.as_dict())
+
+    def as_json(self):
+        """
+        Return the generated resources as JSON
+        """
+        return self._cached_document("json") or _dump_json(self._nodes())
+
+    def as_xml(self):
+        """
+        Return the generated resources in the Rundeck resource XML format
+        """
+        output = self._cached_document("xml")
+        if output is None:
+            stream = io.StringIO()
+            self.write_xml(stream)
+            output = stream.getvalue()
+        return output
+
+    def render(self):
+        """
+        Return the generated resources in the format selected by --output-format
+        """
+        return getattr(self, "as_" + self.options.output_format)()
+
+    def _cached_document(self, output_format):
+        """
+        Return the document served from the resource cache, if it has
+        the requested format
+        """
+        if output_format == self.options.output_format:
+            return self._output
+        return None
+
+    def _cache(self):
+        """
+        Return the resource cache for this invocation, or None if disabled
+        """
+        if not (self.options.cache_ttl or self.options.cache_refresh):
+            return None
+        if self.options.listen or self.options.profiles:
+            return None
+        return ResourceCache(self.options.cache_dir, self._cache_key())
+
+    def _single_flight(self):
+        """
+        Return the single flight coordination for this invocation, or None
+        if --single-flight is not enabled. A server already shares one
+        result between all of its requests.
+        """
+        if not self.options.single_flight or self.options.listen or self.options.profiles:
+            return None
+        return SingleFlight(self.options.cache_dir, self._cache_key())
+
+    def _last_good(self):
+        """
+        Return the last good output for this invocation, or None if
+        --fallback is not enabled. A server keeps serving its previous
+        result instead.
+        """
+        if not self.options.fallback or self.options.listen or self.options.profiles:
+            return None
+        return LastGoodOutput(self.options.cache_dir, self._cache_key())
+
+    def _cache_key(self):
+        """
+        Return the key of the documents generated with these options
+        """
+        return ResourceCache.make_key(
+            tgt=self.config["tgt"],
+            tgt_type=self.config["selected_target_option"],
+            **self._target_key(),
+            mine_function=self.options.mine_function,
+            attributes=self.options.attributes,
+            tags=self.options.tags,
+            static=sorted(self.static.items()),
+            delimiter=self.options.delimiter,
+            include_server_node=self.options.include_server_node,
+            server_node_user=self.options.server_node_user,
+            output_format=self.options.output_format,
+            backend=self.options.backend,
+            **self._backend_key(),
+        )
+
+    def _target_key(self):
+        """
+        Return the arguments that add the --target-spec targets and
+        --canonical to a key, only when they are given, so that other
+        keys are unchanged
+        """
+        key = {}
+        if self.options.target_specs:
+            key["target_specs"] = self.options.target_specs
+        if self.options.canonical:
+            key["canonical"] = True
+        return key
+
+    def _backend_key(self):
+        """
+        Return the arguments that add the source of the Salt Mine data read
+        by a local backend to a key, so that documents generated from
+        different sources are never mixed
+        """
+        if self.options.backend == "master-cache":
+            return {"master_cache_dir": os.path.abspath(self.options.master_cache_dir)}
+        if self.options.backend == "fixture":
+            return {"fixture_file": os.path.abspath(self.options.fixture_file)}
+        if self.options.backend == "synthetic":
+            return {"synthetic_count": self.options.synthetic_count}
+        return {}
+
+    def _check_node_drop(self, previous):
+        """
+        Raise ValueError if the number of nodes dropped by more than
+        --max-node-drop percent from the previous number
+        """
+        limit = self.options.max_node_drop
+        if limit is None or not previous:
+            return
+        drop = 100.0 * (previous - len(self.resources)) / previous
+        if drop > limit:
+            raise ValueError(
+                "The number of nodes dropped by {:.1f}% from {} to {}, "
+                "more than the {:g}% allowed by --max-node-drop".format(
+                    drop, previous, len(self.resources), limit
+                )
+            )
+
+    def _fall_back(self, last_good, reason):
+        """
+        Replace the generated resources with the last good output,
+        and return True, or return False if there is none
+        """
+        age = last_good.age()
+        output = last_good.read() if age is not None else None
+        if output is None:
+            LOG.error("No last good output to print instead: %s", reason)
+            return False
+
+        LOG.warning(
+            "Printing the last good output from %.0f seconds ago instead: %s",
+            age,
+            reason,
+        )
+        self.resources = {}
+        self._mine = None
+        self._output = output
+        self.stats["fallback"] = {"reason": str(reason), "age_seconds": age}
+        return True
+
+    def write(self, stream):
+        """
+        Write the resources to a stream in the format selected by --output-format
+        """
+        counter = _ByteCounter(stream)
+        if self._mine is None:
+            with self._stage("render"):
+                output = self.render()
+            with self._stage("write"):
+                counter.write(output)
+        else:
+            # Nodes are converted while they are written
+            with self._stage("write", profile=True):
+                getattr(self, "write_" + self.options.output_format)(counter)
+        self._counts["output_bytes"] += counter.count
+        self._output_hash(counter.digest.hexdigest())
+
+    def write_file(self, path):
+        """
+        Write the resources to a file, which is replaced atomically and only
+        when its content changed. Returns True if the file was replaced,
+        False if it was unchanged, or None if it could not be written.
+        """
+        changed = _write_output_file(path, self.write)
+        if changed is not None:
+            self.stats["output_changed"] = changed
+        return changed
+
+    def _output_hash(self, digest):
+        """
+        Record the SHA-256 hash of the output, so that consumers
+        can tell whether it changed
+        """
+        self.stats["output_sha256"] = digest
+        LOG.info("Output SHA-256: %s", digest)
+
+    def write_yaml(self, stream):
+        """
+        Write the resources to a stream as YAML. With --stream, nodes are
+        converted and written one at a time, so the complete resource
+        dictionary and document are never held in memory.
+        """
+        if self._mine is None:
+            stream.write(self.as_yaml())
+            return
+
+        dumper = getattr(yaml, "CSafeDumper", None)
+        count = 0
+        for name, node in self._iter_nodes(self._mine, ordered=True):
+            stream.write(_dump_node(name, node, dumper))
+            count += 1
+
+        if not count:
+            LOG.warning("No resources returned.")
+            stream.write(self._dump_yaml({}))
+
+    def write_json(self, stream):
+        """
+        Write the resources to a stream as JSON. With --stream, nodes are
+        converted and written one at a time.
+        """
+        if self._mine is None:
+            stream.write(self.as_json())
+            return
+
+        stream.write("{")
+        separator = ""
+        for name, node in self._iter_nodes(self._mine, ordered=True):
+            stream.write(separator + _dump_json(name) + ":" + _dump_json(node))
+            separator = ","
+        stream.write("}")
+
+    def write_xml(self, stream):
+        """
+        Write the resources to a stream in the Rundeck resource XML format.
+        Nodes are written one at a time, and with --stream they are also
+        converted one at a time.
+        """
+        if self._mine is None:
+            output = self._cached_document("xml")
+            if output is not None:
+                stream.write(output)
+                return
+            nodes = sorted(self._nodes().items())
+        else:
+            nodes = self._iter_nodes(self._mine, ordered=True)
+
+        stream.write('<?xml version="1.0" encoding="UTF-8"?>\n<project>\n')
+        for name, node in nodes:
+            stream.write(_xml_node(name, node))
+        stream.write("</project>\n")
+
+    def write_profiles(self):
+        """
+        Generate the output of every batch profile, and write each one
+        atomically to its output path. Profiles that can be matched locally
+        share a single call to the Salt Mine.
+
+        Returns the number of profiles that could not be written.
+        """
+        profiles = self.options.profiles
+        generators = [self._for_profile(profile) for profile in profiles]
+        shared = [p for p in profiles if p["tgt_type"] in _COMPOUND_PREFIXES]
+        mine = {}
+        if shared:
+            mine = self._project(
+                self._call_mine(*self._union_target(shared)),
+                self._profile_grains(profiles, generators),
+            )
+
+        failed = 0
+        for profile, generator in zip(profiles, generators):
+            if profile["tgt_type"] in _COMPOUND_PREFIXES:
+                selected = {
+                    minion: grains
+                    for minion, grains in mine.items()
+                    if _match_target(
+                        minion,
+                        grains,
+                        profile["tgt"],
+                        profile["tgt_type"],
+                        self.options.delimiter,
+                    )
+                }
+            else:
+                # pylint: disable=protected-access
+                selected = generator._project(
+                    self._call_mine(profile["tgt"], profile["tgt_type"]),
+                    generator._grain_keys,
+                )
+
+            generator._convert(selected)  # pylint: disable=protected-access
+            self.stats.setdefault("profiles", {})[profile["name"]] = generator.stats
+            try:
+                with self._stage("render"):
+                    output = generator.render()
+                changed = _write_if_changed(
+                    profile["output"], lambda stream, output=output: stream.write(output)
+                )
+                data = output.encode("utf-8")
+                self._counts["output_bytes"] += len(data)
+                generator.stats["output_sha256"] = hashlib.sha256(data).hexdigest()
+                generator.stats["output_changed"] = changed
+            except OSError as exc:
+                LOG.error(
+                    "Unable to write profile '%s' to '%s': %s",
+                    profile["name"],
+                    profile["output"],
+                    exc,
+                )
+                failed += 1
+                continue
+            LOG.info(
+                "Profile '%s' wrote %d nodes to '%s'",
+                profile["name"],
+                len(generator.resources),
+                profile["output"],
+            )
+        return failed
+
+    def _for_profile(self, profile):
+        """
+        Return a copy of this generator that uses the options of a batch profile
+        """
+        generator = copy.copy(self)
+        generator.options = copy.copy(self.options)
+        generator.options.attributes = profile["attributes"]
+        generator.options.tags = profile["tags"]
+        generator.config = dict(
+            self.config,
+            tgt=profile["tgt"],
+            selected_target_option=profile["tgt_type"],
+            targets=[(profile["tgt"], profile["tgt_type"])],
+        )
+        generator.static = profile["static"]
+        generator.resources = {}
+        generator.stats = {}
+        generator._compile_plan()  # pylint: disable=protected-access
+        return generator
+
+    def _profile_grains(self, profiles, generators):
+        """
+        Return the grains needed to match and convert the nodes of
+        several batch profiles
+        """
+        keys = set()
+        for profile, generator in zip(profiles, generators):
+            keys.update(generator._grain_keys)  # pylint: disable=protected-access
+            keys.update(
+                _target_grains(profile["tgt"], profile["tgt_type"], self.options.delimiter)
+            )
+        return sorted(keys)
+
+    def mine_config(self):
+        """
+        Return a minion configuration that defines a Salt Mine function
+        returning only the grains used by the current options
+        """
+        if self.options.profiles:
+            profiles = self.options.profiles
+            keys = self._profile_grains(
+                profiles, [self._for_profile(profile) for profile in profiles]
+            )
+        else:
+            keys = self._grain_keys
+        return yaml.safe_dump(
+            {
+                "mine_functions": {
+                    self._mine_alias: [{"mine_function": "grains.item"}] + list(keys)
+                }
+            },
+            default_flow_style=False,
+        )
+
+    def _union_target(self, profiles):
+        """
+        Return a target and target type that match every minion
+        targeted by any of the given profiles
+        """
+        if len(profiles) == 1:
+            return profiles[0]["tgt"], profiles[0]["tgt_type"]
+        # Local backends cannot match compound targets, and every profile is
+        # matched locally by write_profiles anyway
+        if self._backend().matches_locally:
+            return "*", "glob"
+
+        expressions = []
+        for profile in profiles:
+            tgt = profile["tgt"]
+            if profile["tgt_type"] == "list":
+                tgt = ",".join(tgt)
+            # Compound expressions are whitespace delimited and use the default
+            # delimiter, so fall back to all minions when they cannot be used
+            if (
+                (profile["tgt_type"] == "glob" and tgt == "*")
+                or any(char.isspace() for char in tgt)
+                or self.options.delimiter != ":"
+            ):
+                return "*", "glob"
+            expressions.append(_COMPOUND_PREFIXES[profile["tgt_type"]] + tgt)
+        return " or ".join(expressions), "compound"
+
+    def generate(self):
+        """
+        Call the Salt Mine and return a new dictionary of node definitions.
+        The options are only parsed once, and the backend, such as the
+        Salt Caller, is created by the first call and reused, so a
+        long-running process can call this whenever it needs the nodes.
+        Calls must not be made from several threads at the same time.
+        """
+        self.regenerate()
+        return self.as_dict()
+
+    def regenerate(self):
+        """
+        Call the Salt Mine again and replace the generated resources
+        """
+        self._reset_timings()
+        self.stats = {}
+        self._output = None
+        self._mine = None
+        self._generate()
+
+    @staticmethod
+    def _dump_yaml(resources):
+        return yaml.safe_dump(resources, default_flow_style=False)
+
+    def _generate(self):
+        """
+        The main function for SaltGenResource. This method calls the Salt Mine
+        and converts the returned data into a dictionary that conforms to the
+        Rundeck specification for an external resource generator.
+
+        The return is a Python dictionary. The caller is responsible for converting
+        the dictionary into YAML for consumption by Rundeck.
+        """
+
+        mine = self._call_targets(self._targets())
+        self._convert(self._project(mine, self._grain_keys))
+
+    def _reset_timings(self):
+        self._timings = {}
+        self._started = time.perf_counter()
+        self._counts = dict.fromkeys(
+            (
+                "minions",
+                "nodes",
+                "attributes",
+                "tags",
+                "warnings",
+                "skipped_attributes",
+                "skipped_tags",
+                "output_bytes",
+            ),
+            0,
+        )
+
+    @contextlib.contextmanager
+    def _stage(self, name, profile=False):
+        """
+        Add the wall and CPU time spent in the body of the with statement,
+        and the warnings logged, to the timings of a stage. With profile,
+        the body is profiled if --profile-file was given.
+        """
+        profiler = self._profiler if profile else None
+        counter = _WarningCounter()
+        LOG.addHandler(counter)
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            timing = self._timings.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+            timing["wall"] += time.perf_counter() - wall
+            timing["cpu"] += time.process_time() - cpu
+            LOG.removeHandler(counter)
+            self._counts["warnings"] += counter.count
+            if profiler is not None:
+                try:
+                    profiler.dump_stats(self.options.profile_file)
+                except OSError as exc:
+                    LOG.error(
+                        "Unable to write profile to '%s': %s",
+                        self.options.profile_file,
+                        exc,
+                    )
+
+    def _call_mine(self, tgt, tgt_type):
+        """
+        Fetch the Salt Mine data of every minion matching a target
+        from the backend
+        """
+        LOG.debug(
+            "Fetching Salt Mine data from the %s backend with target: '%s' type: '%s'",
+            self.options.backend,
+            tgt,
+            tgt_type,
+        )
+        with self._stage("mine"):
+            mine = self._fetch(tgt, tgt_type)
+        self._counts["minions"] += len(mine)
+        LOG.debug(
             "Salt Mine function '%s' returned %d minion%s",
-            self._mine_func,
+            self.options.mine_function,
             len(mine),
             "" if len(mine) == 1 else "s",
         )
+        return mine
 
-        # Special handling for server node
-        if self.options.include_server_node is True:
-            # Map required node attributes from grains
-            local_grains = caller.sminion.opts["grains"]
-            self.resources[self._server_node_name] = {
-                "hostname": self._server_node_name,
-                "description": "Rundeck server node",
-                "username": self.options.server_node_user,
-                "osName": local_grains["kernel"],
-                "osVersion": local_grains["kernelrelease"],
-                "osFamily": self._os_family(local_grains["kernel"]),
-                "osArch": self._os_arch(local_grains["cpuarch"]),
-            }
-            # Create additional attributes from grains
-            self.resources[self._server_node_name].update(
-                self._create_attributes(self._server_node_name, local_grains)
+    def _fetch(self, tgt, tgt_type):
+        """
+        Call the backend, and raise TimeoutError if it does not return
+        within --fetch-timeout seconds. The call is made in a daemon
+        thread, which is abandoned when it times out, along with the
+        backend it uses.
+        """
+        backend = self._backend()
+        timeout = self.options.fetch_timeout
+        if not timeout:
+            return backend.mine(tgt, tgt_type)
+
+        with self._abandoned_lock:
+            abandoned = ResourceGenerator._abandoned_fetches
+            abandoned[:] = [thread for thread in abandoned if thread.is_alive()]
+            if len(abandoned) >= self._max_abandoned_fetches:
+                raise TimeoutError(
+                    "{} earlier Salt Mine calls that timed out are still running".format(
+                        len(abandoned)
+                    )
+                )
+
+        result = {}
+
+        def fetch():
+            try:
+                result["mine"] = backend.mine(tgt, tgt_type)
+            except Exception as exc:  # pylint: disable=broad-except
+                result["error"] = exc
+
+        thread = threading.Thread(target=fetch, name="mine-fetch", daemon=True)
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            with self._abandoned_lock:
+                ResourceGenerator._abandoned_fetches.append(thread)
+            # The abandoned call may still use the backend, so the next call
+            # gets a new one
+            if self.backend is backend:
+                self.backend = None
+            raise TimeoutError(
+                "Salt Mine data was not fetched within {:g} seconds".format(timeout)
             )
+        if "error" in result:
+            raise result["error"]
+        return result["mine"]
 
-            # Create static attributes
-            self.resources[self._server_node_name].update(
-                {
-                    k: v
-                    for k, v in self.static.items()
-                    if k
-                    not in SaltNodesCommandParser.ignore_attributes
-                    + SaltNodesCommandParser.ignore_servernode
-                }
+    def _targets(self):
+        """
+        Return the (tgt, tgt_type) tuples of every target to include
+        """
+        return self.config.get("targets") or [
+            (self.config["tgt"], self.config["selected_target_option"])
+        ]
+
+    def _call_targets(self, targets):
+        """
+        Fetch the Salt Mine data of every minion matching any of several
+        targets, with one call per target, made at the same time when the
+        backend allows it, and merge them. The time taken by each call is
+        added to the stats.
+        """
+        if len(targets) == 1:
+            return self._call_mine(*targets[0])
+
+        import concurrent.futures  # pylint: disable=import-outside-toplevel
+
+        def fetch(target):
+            start = time.perf_counter()
+            mine = self._fetch(*target)
+            return mine, time.perf_counter() - start
+
+        with self._stage("mine"):
+            workers = len(targets) if self._backend().concurrent else 1
+            with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+                results = list(pool.map(fetch, targets))
+
+        merged = {}
+        self.stats["targets"] = []
+        for (tgt, tgt_type), (mine, seconds) in zip(targets, results):
+            LOG.debug(
+                "Target: '%s' type: '%s' returned %d minion%s in %.3fs",
+                tgt,
+                tgt_type,
+                len(mine),
+                "" if len(mine) == 1 else "s",
+                seconds,
+            )
+            self.stats["targets"].append(
+                {"tgt": tgt, "tgt_type": tgt_type, "minions": len(mine), "seconds": seconds}
             )
+            for minion, grains in mine.items():
+                merged.setdefault(minion, grains)
+        self._counts["minions"] += len(merged)
+        return merged
 
-            # Create tags from grains
-            tags = self._create_tags(self._server_node_name, local_grains)
-            if len(tags) > 0:
-                self.resources[self._server_node_name]["tags"] = tags
-
-        # Map grains into a Rundeck resource dict
-        for minion, minion_grains in mine.items():
-            # Map required node attributes from grains
-            self.resources[minion] = {
-                "hostname": minion_grains["fqdn"],
-                "osName": minion_grains["kernel"],
-                "osVersion": minion_grains["kernelrelease"],
-                "osFamily": self._os_family(minion_grains["kernel"]),
-                "osArch": self._os_arch(minion_grains["cpuarch"]),
+    def _backend(self):
+        """
+        Create the backend selected by the options, or return the one
+        created before. The backend is shared with batch profile copies.
+        """
+        if self.backend is None:
+            self.backend = BACKENDS[self.options.backend](self.config, self.options)
+        return self.backend
+
+    def _convert(self, mine):
+        """
+        Convert the data returned by the Salt Mine into node definitions
+        """
+        with self._stage("convert", profile=True):
+            self.resources = dict(self._iter_nodes(mine, ordered=self.options.canonical))
+
+        if not self.resources:
+            LOG.warning("No resources returned.")
+
+    def _iter_nodes(self, mine, ordered=False):
+        """
+        Convert the data returned by the Salt Mine one node at a time,
+        yielding a (name, node record) tuple for each. When ordered is True,
+        nodes are yielded in the same order that YAML output sorts them.
+        """
+        server_node = self.options.include_server_node is True
+        if ordered:
+            names = sorted(mine)
+            if server_node and self._server_node_name not in mine:
+                bisect.insort(names, self._server_node_name)
+        else:
+            names = list(mine)
+            if server_node and self._server_node_name not in mine:
+                names.insert(0, self._server_node_name)
+
+        minions = [name for name in names if name in mine]
+
+        # The level is checked once, rather than for each debug message
+        self._debug = (
+            LOG.isEnabledFor(logging.DEBUG) and _handled_level(LOG) <= logging.DEBUG
+        )
+        self._diagnostics = {}
+
+        # Reuse the nodes of minions whose grains are unchanged since the last run
+        previous = self._load_node_state() if self.options.incremental else None
+        reused = {}
+        if previous is not None:
+            fingerprints = {name: self._fingerprint(mine[name]) for name in minions}
+            reused = {
+                name: previous[name][1]
+                for name in minions
+                if name in previous
+                and fingerprints[name] is not None
+                and previous[name][0] == fingerprints[name]
+            }
+            minions = [name for name in minions if name not in reused]
+
+        if self.options.workers > 1 and len(minions) > 1:
+            nodes = self._iter_parallel(mine, minions)
+        else:
+            nodes = (self._minion_node(name, mine[name]) for name in minions)
+        # The nodes are converted in the order of minions, which is the order
+        # of names without the reused nodes and the server node
+        nodes = zip(minions, nodes)
+
+        # Nodes share their attribute names and repeated values, such as
+        # the OS names and static attributes, until they are written
+        table = _NodeTable()
+        state = {}
+        for name in names:
+            if name in reused:
+                node = reused[name]
+            elif name in mine:
+                converted, node = next(nodes, (None, None))
+                if converted != name:
+                    raise RuntimeError("No node was converted for minion '{}'".format(name))
+            else:
+                node = self._server_node()
+            if self.options.canonical:
+                node = _canonical_node(node)
+            node = table.compact(node)
+            if previous is not None and name in mine:
+                state[name] = (fingerprints[name], node)
+            tags = len(node.get("tags", ()))
+            self._counts["nodes"] += 1
+            self._counts["attributes"] += len(node) - (1 if tags else 0)
+            self._counts["tags"] += tags
+            yield name, node
+
+        if previous is not None:
+            counts = {
+                "reused": len(reused),
+                "rebuilt": len(minions),
+                "removed": len(set(previous).difference(mine)),
             }
-            # Create additional attributes from grains
-            self.resources[minion].update(
-                self._create_attributes(minion, minion_grains)
+            LOG.debug(
+                "Incremental generation reused %(reused)d nodes, "
+                "rebuilt %(rebuilt)d and removed %(removed)d",
+                counts,
             )
-            # Create static attributes
-            self.resources[minion].update(
-                {
-                    k: v
-                    for k, v in self.static.items()
-                    if k not in SaltNodesCommandParser.ignore_attributes
+            self.stats["nodes"] = counts
+            self._save_node_state(state)
+
+        self._log_diagnostics()
+
+    def _project(self, mine, keys):
+        """
+        Discard the grains of every minion that are not in keys, so that only
+        the grains needed for the node definitions are kept in memory.
+        The mine dictionary is changed in place and returned.
+        """
+        measure = bool(self.options.stats_file)
+        received = retained = 0
+        for minion, grains in mine.items():
+            if not isinstance(grains, dict):
+                continue
+            projected = {key: grains[key] for key in keys if key in grains}
+            if measure:
+                received += _encoded_size(grains)
+                retained += _encoded_size(projected)
+            mine[minion] = projected
+
+        if measure:
+            LOG.debug(
+                "Received %d bytes of grains, retained %d bytes", received, retained
+            )
+            self.stats["grains"] = {
+                "received_bytes": received,
+                "retained_bytes": retained,
+            }
+        return mine
+
+    def _fingerprint(self, grains):
+        """
+        Return a digest of the grains that the node definition of
+        a minion depends on, or None if they cannot be encoded
+        """
+        used = {key: grains[key] for key in self._grain_keys if key in grains}
+        try:
+            encoded = json.dumps(used, sort_keys=True, default=repr)
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+    def _node_state_path(self):
+        """
+        Return the path of the stored node definitions for these options
+        """
+        key = ResourceCache.make_key(
+            tgt=self.config["tgt"],
+            tgt_type=self.config["selected_target_option"],
+            **self._target_key(),
+            mine_function=self.options.mine_function,
+            attributes=self.options.attributes,
+            tags=self.options.tags,
+            static=sorted(self.static.items()),
+            delimiter=self.options.delimiter,
+            **self._backend_key(),
+        )
+        return os.path.join(self.options.cache_dir, "nodes-{}.json".format(key))
+
+    def _load_node_state(self):
+        """
+        Return the node definitions stored by the previous run as a
+        dictionary of (fingerprint, node) tuples by minion name
+        """
+        path = self._node_state_path()
+        if self._node_state is not None and self._node_state[0] == path:
+            return self._node_state[1]
+        try:
+            with open(path, "r", encoding="utf-8") as stream:
+                return {
+                    name: tuple(entry) for name, entry in json.load(stream).items()
                 }
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            LOG.warning("Ignoring stored nodes in '%s': %s", path, exc)
+            return {}
+
+    def _save_node_state(self, state):
+        """
+        Store the node definitions of this run for the next one
+        """
+        path = self._node_state_path()
+        self._node_state = (path, state)
+        try:
+            _atomic_write(path, _dump_json(state))
+        except (OSError, TypeError, ValueError) as exc:
+            LOG.warning("Unable to store nodes in '%s': %s", path, exc)
+
+    def write_stats(self):
+        """
+        Write the statistics of this run as JSON, if requested
+        """
+        stats_file = self.options.stats_file
+        if self.options.timings:
+            stats_file = stats_file or "-"
+            self.stats["timings"] = self._timings
+            self.stats["counts"] = self._counts
+        if stats_file:
+            _write_stats(stats_file, self.stats)
+
+    def report(self):
+        """
+        Write the statistics and metrics of this run, if requested
+        """
+        self.write_stats()
+        self.write_metrics()
+
+    def write_metrics(self):
+        """
+        Write metrics about this run to the --metrics-file in the Prometheus
+        text format, for the textfile collector of the node exporter
+        """
+        if not self.options.metrics_file:
+            return
+
+        def seconds(*stages):
+            return sum(self._timings.get(stage, {}).get("wall", 0.0) for stage in stages)
+
+        counts = self._counts
+        fallback = self.stats.get("fallback", {})
+        nodes = counts["nodes"] if self._cached_nodes is None else self._cached_nodes
+        metrics = [
+            (
+                "duration_seconds",
+                "Wall time of the last run.",
+                [("", time.perf_counter() - self._started)],
+            ),
+            (
+                "cache_hit",
+                "Whether the output was served from the resource cache.",
+                [("", 1 if self.stats.get("cache_hit") else 0)],
+            ),
+            (
+                "mine_duration_seconds",
+                "Wall time spent fetching Salt Mine data.",
+                [("", seconds("mine"))],
+            ),
+            (
+                "serialization_duration_seconds",
+                "Wall time spent rendering and writing the output.",
+                [("", seconds("render", "write"))],
+            ),
+            ("minions", "Minions returned by the Salt Mine.", [("", counts["minions"])]),
+            ("nodes", "Node definitions generated.", [("", nodes)]),
+            (
+                "skipped_grains",
+                "Requested grains skipped because their type is not supported.",
+                [
+                    ('{kind="attribute"}', counts["skipped_attributes"]),
+                    ('{kind="tag"}', counts["skipped_tags"]),
+                ],
+            ),
+            ("output_bytes", "Size of the output in bytes.", [("", counts["output_bytes"])]),
+            (
+                "fallback",
+                "Whether the last good output was printed instead of a new one.",
+                [("", 1 if fallback else 0)],
+            ),
+            (
+                "fallback_age_seconds",
+                "Age of the last good output printed instead of a new one.",
+                [("", fallback.get("age_seconds", 0.0))],
+            ),
+            (
+                "last_run_timestamp_seconds",
+                "Time at which the last run finished.",
+                [("", time.time())],
+            ),
+        ]
+        if "output_changed" in self.stats:
+            metrics.append(
+                (
+                    "output_changed",
+                    "Whether the output file was replaced because its content changed.",
+                    [("", 1 if self.stats["output_changed"] else 0)],
+                )
             )
-            # Create tags from grains
-            tags = self._create_tags(minion, minion_grains)
-            if len(tags) > 0:
-                self.resources[minion]["tags"] = tags
+        _write_metrics(self.options.metrics_file, metrics)
 
-        if not self.resources:
-            LOG.warning("No resources returned.")
+    def _iter_parallel(self, mine, names):
+        """
+        Convert the minions in names with a pool of worker processes,
+        yielding their nodes in the same order. The log records of each
+        node are handled here, just before the node is yielded.
+        """
+        # pylint: disable=import-outside-toplevel
+        import concurrent.futures
+        import multiprocessing
+
+        workers = self.options.workers
+        size = -(-len(names) // (workers * 4))
+
+        # Forked workers inherit the generator and the mine data without
+        # copying them, and hash strings like this process, so tag lists
+        # come out in the same order as when converted here.
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(self, mine, names, size),
+        )
+        try:
+            results = pool.map(_convert_chunk, range(0, len(names), size))
+            for chunk, counts, diagnostics in results:
+                for key, value in counts.items():
+                    self._counts[key] += value
+                self._merge_diagnostics(diagnostics)
+                for node, records in chunk:
+                    for record in records:
+                        LOG.handle(record)
+                    yield node
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    def _server_node(self):
+        """
+        Create the node definition for the Rundeck server
+        """
+        # Map required node attributes from grains
+        local_grains = self._backend().grains(self._server_grain_keys)
+        node = {
+            "hostname": self._server_node_name,
+            "description": "Rundeck server node",
+            "username": self.options.server_node_user,
+            "osName": local_grains["kernel"],
+            "osVersion": local_grains["kernelrelease"],
+            "osFamily": self._os_family(local_grains["kernel"]),
+            "osArch": self._os_arch(local_grains["cpuarch"]),
+        }
+        # Create additional attributes from grains
+        node.update(self._create_attributes(self._server_node_name, local_grains))
+
+        # Create static attributes
+        node.update(
+            {
+                k: v
+                for k, v in self.static.items()
+                if k
+                not in SaltNodesOptionsMixIn.ignore_attributes
+                + SaltNodesOptionsMixIn.ignore_servernode
+            }
+        )
+
+        # Create tags from grains
+        tags = self._create_tags(self._server_node_name, local_grains)
+        if len(tags) > 0:
+            node["tags"] = tags
+        return node
+
+    def _minion_node(self, minion, minion_grains):
+        """
+        Create the node definition for a minion from its grains
+        """
+        # Map required node attributes from grains
+        node = {
+            "hostname": minion_grains["fqdn"],
+            "osName": minion_grains["kernel"],
+            "osVersion": minion_grains["kernelrelease"],
+            "osFamily": self._os_family(minion_grains["kernel"]),
+            "osArch": self._os_arch(minion_grains["cpuarch"]),
+        }
+        # Create additional attributes from grains
+        node.update(self._create_attributes(minion, minion_grains))
+
+        # Create static attributes
+        node.update(
+            {
+                k: v
+                for k, v in self.static.items()
+                if k not in SaltNodesOptionsMixIn.ignore_attributes
+            }
+        )
+        # Create tags from grains
+        tags = self._create_tags(minion, minion_grains)
+        if len(tags) > 0:
+            node["tags"] = tags
+        return node
+
+    def _compile_plan(self):
+        """
+        Prepare the lookups of requested attribute and tag grains, so that
+        their key paths are split once rather than for every minion
+        """
+        delimiter = self.options.delimiter
+        self._attribute_plan = [
+            (item, item.replace(":", "_"), _grain_lookup(item, delimiter, ""))
+            for item in self.options.attributes
+        ]
+        self._tag_plan = [
+            (item, _grain_lookup(item, delimiter, None)) for item in self.options.tags
+        ]
+        # Top-level grains that a node definition depends on
+        requested = {
+            item.split(delimiter)[0]
+            for item in (*self.options.attributes, *self.options.tags)
+        }
+        self._grain_keys = sorted(requested.union(self._required_grains))
+        self._server_grain_keys = sorted(requested.union(self._server_required_grains))
 
     def _create_attributes(self, minion, grains):
         """
         Loop over requested attributes and request a value for each
         """
         attributes = {}
-        for item in self.options.attributes:
+        for item, key, lookup in self._attribute_plan:
             try:
-                key, value = self._attribute_from_grain(item, grains)
+                value = lookup(grains)
+                if isinstance(value, list):
+                    self._diagnose(item, "list", minion)
+                value = self._get_grain_value(value, 0)
                 if value is not None:
-                    LOG.debug(
-                        (
-                            "Adding attribute for minion: "
-                            "'%s' grain: '%s', attribute: '%s', value: '%s'"
-                        ),
-                        minion,
-                        item,
-                        key,
-                        value,
-                    )
+                    if self._debug:
+                        LOG.debug(
+                            (
+                                "Adding attribute for minion: "
+                                "'%s' grain: '%s', attribute: '%s', value: '%s'"
+                            ),
+                            minion,
+                            item,
+                            key,
+                            value,
+                        )
                     attributes[key] = value
                 else:
-                    LOG.warning(
-                        "Requested grain '%s' is not available on minion: %s",
-                        item,
-                        minion,
-                    )
+                    self._diagnose(item, "missing", minion)
             except TypeError:
-                LOG.warning(
-                    "Minion '%s' grain '%s' ignored because grain type is unsupported.",
-                    minion,
-                    item,
-                )
+                self._counts["skipped_attributes"] += 1
+                self._diagnose(item, "attribute_type", minion)
         return attributes
 
-    def _attribute_from_grain(self, item, grains):
-        """
-        Provide the value for a single attribute from a grain
-        """
-        key = item.replace(":", "_")
-        value = datautils.traverse_dict_and_list(
-            grains, item, default="", delimiter=self.options.delimiter
-        )
-
-        if isinstance(value, list):
-            LOG.warning(
-                "Grain '%s' is a list. First item will be selected by default.", item
-            )
-
-        return key, ResourceGenerator._get_grain_value(value, 0)
-
     @staticmethod
     def _get_grain_value(value, depth):
         """
@@ -481,43 +3447,61 @@ class ResourceGenerator:
         Loop over requested tags and request a value for each
         """
         tags = set()
-        for item in self.options.tags:
+        for item, lookup in self._tag_plan:
             try:
-                new_tags = self._tags_from_grain(item, grains)
+                new_tags = self._tags_from_value(lookup(grains), 0)
                 if not new_tags:
-                    LOG.warning(
-                        "Requested grain '%s' is not available on minion: %s",
-                        item,
-                        minion,
-                    )
+                    self._diagnose(item, "missing", minion)
                 for tag in new_tags:
-                    LOG.debug(
-                        "Adding tag for minion: '%s', grain: '%s', tag: '%s'",
-                        minion,
-                        item,
-                        tag,
-                    )
+                    if self._debug:
+                        LOG.debug(
+                            "Adding tag for minion: '%s', grain: '%s', tag: '%s'",
+                            minion,
+                            item,
+                            tag,
+                        )
                     tags.add(tag)
             except TypeError:
-                LOG.warning(
-                    (
-                        "Tag not added for minion: '%s', grain: '%s' "
-                        "because its data type is not supported."
-                    ),
-                    minion,
-                    item,
-                )
+                self._counts["skipped_tags"] += 1
+                self._diagnose(item, "tag_type", minion)
         return list(tags)
 
-    def _tags_from_grain(self, item, grains):
+    def _diagnose(self, item, reason, minion):
         """
-        Define a single tag from a grain value
+        Count a problem with a requested grain on a minion, to be summarized
+        by _log_diagnostics(). The details are only logged at debug level.
         """
-        value = datautils.traverse_dict_and_list(
-            grains, item, default=None, delimiter=self.options.delimiter
-        )
+        entry = self._diagnostics.get((item, reason))
+        if entry is None:
+            entry = self._diagnostics[(item, reason)] = [0, []]
+        entry[0] += 1
+        if len(entry[1]) < self.options.warn_examples:
+            entry[1].append(minion)
+        if self._debug:
+            LOG.debug(self._diagnostic_details[reason], item, minion)
+
+    def _merge_diagnostics(self, diagnostics):
+        """
+        Add the diagnostics collected by a worker process
+        """
+        for key, (count, examples) in diagnostics.items():
+            entry = self._diagnostics.setdefault(key, [0, []])
+            entry[0] += count
+            entry[1].extend(examples[: self.options.warn_examples - len(entry[1])])
 
-        return self._tags_from_value(value, 0)
+    def _log_diagnostics(self):
+        """
+        Log one warning for each problem with a requested grain, with the
+        number of minions affected and the first of them if requested
+        """
+        for (item, reason), (count, examples) in sorted(self._diagnostics.items()):
+            message = self._diagnostic_summaries[reason]
+            args = [item, count, "" if count == 1 else "s"]
+            if examples:
+                message += " (%s%s)"
+                args += [", ".join(examples), ", ..." if count > len(examples) else ""]
+            LOG.warning(message, *args)
+        self._diagnostics = {}
 
     @staticmethod
     def _tags_from_value(value, depth):
@@ -580,6 +3564,342 @@ class ResourceGenerator:
         return value
 
 
+class ResourceServer:
+    """
+    Serve resources over HTTP for use as a Rundeck URL resource source.
+
+    A single ResourceGenerator is kept warm, and the Salt Mine is called
+    periodically in a background thread. Requests are answered from
+    documents rendered in memory after each call. Only the --output-format
+    document is rendered with each call, other formats are rendered when
+    they are first requested.
+    """
+
+    # Map document formats to content types and ResourceGenerator methods
+    formats = {
+        "yaml": ("text/yaml; charset=utf-8", "as_yaml"),
+        "json": ("application/json; charset=utf-8", "as_json"),
+        "xml": ("application/xml; charset=utf-8", "as_xml"),
+    }
+
+    def __init__(self, generator, address, interval):
+        self.generator = generator
+        self.interval = interval
+        # Serializes regenerating the resources and rendering documents
+        self._lock = threading.Lock()
+        self.documents = self._render()
+        self.generator.report()
+        self._stop = threading.Event()
+        # pylint: disable=import-outside-toplevel
+        import http.server
+        import socket
+
+        class _HTTPServer(http.server.ThreadingHTTPServer):
+            # IPv6 addresses are given in brackets to --listen
+            address_family = socket.AF_INET6 if ":" in address[0] else socket.AF_INET
+
+        self.httpd = _HTTPServer(address, _request_handler())
+        self.httpd.resource_server = self
+
+    def _render_format(self, name):
+        """
+        Render the generated resources in a format. Returns the document as
+        a (content type, body, ETag) tuple, and the SHA-256 hash of the body.
+        """
+        content_type, method = self.formats[name]
+        body = getattr(self.generator, method)().encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()
+        return (content_type, body, '"{}"'.format(digest[:32])), digest
+
+    def _render(self):
+        """
+        Render the generated resources in the format selected by
+        --output-format, and return a new dictionary of documents by format
+        """
+        # pylint: disable=protected-access
+        name = self.generator.options.output_format
+        with self.generator._stage("render"):
+            document, digest = self._render_format(name)
+        self.generator._output_hash(digest)
+        self.generator._counts["output_bytes"] += len(document[1])
+        return {name: document}
+
+    def document(self, name):
+        """
+        Return the document served for a format, rendering it if it was not
+        requested since the last call to the Salt Mine
+        """
+        documents = self.documents
+        if name not in documents:
+            with self._lock:
+                documents = self.documents
+                if name not in documents:
+                    documents[name] = self._render_format(name)[0]
+        return documents[name]
+
+    def refresh(self):
+        """
+        Call the Salt Mine and replace the documents being served
+        """
+        with self._lock:
+            self.generator.regenerate()
+            self.documents = self._render()
+        self.generator.report()
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception("Unable to refresh resources, serving the previous result")
+
+    def serve_forever(self):
+        """
+        Answer HTTP requests until interrupted
+        """
+        thread = threading.Thread(
+            target=self._refresh_loop, name="resource-refresh", daemon=True
+        )
+        thread.start()
+        LOG.info("Serving resources on %s:%d", *self.httpd.server_address[:2])
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stop.set()
+            self.httpd.server_close()
+
+
+def _request_handler():
+    """
+    Return the request handler class of ResourceServer. http.server loads
+    the http.client and email packages, so it is only imported by a server.
+    """
+    import http.server  # pylint: disable=import-outside-toplevel
+
+    class _ResourceRequestHandler(http.server.BaseHTTPRequestHandler):
+        """
+        Answer requests for resource documents, honoring If-None-Match
+        """
+
+        paths = {
+            "/resources.yaml": "yaml",
+            "/resources.json": "json",
+            "/resources.xml": "xml",
+        }
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            self._respond(include_body=True)
+
+        def do_HEAD(self):  # pylint: disable=invalid-name
+            self._respond(include_body=False)
+
+        def _respond(self, include_body):
+            path = self.path.split("?", 1)[0]
+            if path == "/":
+                accept = self.headers.get("Accept", "")
+                fmt = "yaml"
+                if "application/json" in accept:
+                    fmt = "json"
+                elif "application/xml" in accept or "text/xml" in accept:
+                    fmt = "xml"
+            else:
+                fmt = self.paths.get(path)
+            if fmt is None:
+                self.send_error(404)
+                return
+
+            content_type, body, etag = self.server.resource_server.document(fmt)
+            if self._etag_matches(etag):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            if include_body:
+                self.wfile.write(body)
+
+        def _etag_matches(self, etag):
+            header = self.headers.get("If-None-Match")
+            if not header:
+                return False
+            candidates = [tag.strip() for tag in header.split(",")]
+            return "*" in candidates or any(
+                tag[2:] == etag if tag.startswith("W/") else tag == etag
+                for tag in candidates
+            )
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            LOG.debug("%s - " + format, self.address_string(), *args)
+
+    return _ResourceRequestHandler
+
+
+def _write_stats(path, stats):
+    """
+    Write statistics as JSON to a file, or to stderr if path is "-"
+    """
+    document = json.dumps(stats, indent=2, sort_keys=True) + "\n"
+    if path == "-":
+        sys.stderr.write(document)
+        return
+    try:
+        _atomic_write(path, document, mode=0o644)
+    except OSError as exc:
+        LOG.error("Unable to write statistics to '%s': %s", path, exc)
+
+
+def _write_metrics(path, metrics):
+    """
+    Write (name, description, samples) metrics to a file in the Prometheus
+    text format, where samples are (labels, value) pairs
+    """
+    lines = []
+    for name, description, samples in metrics:
+        name = "salt_gen_resource_" + name
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} gauge".format(name))
+        lines.extend("{}{} {}".format(name, labels, repr(value)) for labels, value in samples)
+    try:
+        _atomic_write(path, "\n".join(lines) + "\n", mode=0o644)
+    except OSError as exc:
+        LOG.error("Unable to write metrics to '%s': %s", path, exc)
+
+
+def _write_cache_hit_metrics(path, started, output, nodes):
+    """
+    Write the metrics of a run that served a document from the resource
+    cache without loading Salt
+    """
+    metrics = [
+        (
+            "duration_seconds",
+            "Wall time of the last run.",
+            [("", time.perf_counter() - started)],
+        ),
+        (
+            "cache_hit",
+            "Whether the output was served from the resource cache.",
+            [("", 1)],
+        ),
+        (
+            "output_bytes",
+            "Size of the output in bytes.",
+            [("", len(output.encode("utf-8")))],
+        ),
+        (
+            "last_run_timestamp_seconds",
+            "Time at which the last run finished.",
+            [("", time.time())],
+        ),
+    ]
+    if nodes is not None:
+        metrics.insert(2, ("nodes", "Node definitions generated.", [("", nodes)]))
+    _write_metrics(path, metrics)
+
+
+def _scan_options(argv, names):
+    """
+    Extract the values of long options from command arguments without
+    a full parse. Returns None if the arguments request something other
+    than generating resources.
+    """
+    values = {}
+    for index, arg in enumerate(argv):
+        if arg in ("-h", "--help", "-V", "--versions-report", "--version"):
+            return None
+        # The timings of every stage are only measured by a full run
+        if arg in ("--cache-refresh", "--timings"):
+            return None
+        for name in names:
+            if arg == name and index + 1 < len(argv):
+                values[name] = argv[index + 1]
+            elif arg.startswith(name + "="):
+                values[name] = arg[len(name) + 1 :]
+    return values
+
+
+def _cached_output(argv):
+    """
+    Serve the resource cache for these command arguments without loading Salt.
+
+    Returns the cached document and its number of nodes, or None if the
+    arguments must be parsed and the Salt Mine called.
+    """
+    options = _scan_options(argv, ("--cache-ttl", "--cache-stale-ttl", "--cache-dir"))
+    if options is None:
+        return None
+
+    try:
+        ttl = int(options.get("--cache-ttl", 0))
+        stale_ttl = int(options.get("--cache-stale-ttl", 0))
+    except ValueError:
+        return None
+    if ttl <= 0:
+        return None
+
+    # The default location depends on the cachedir of the minion
+    # configuration, which is only known once Salt reads it
+    cache_dir = options.get("--cache-dir")
+    if cache_dir is None:
+        return None
+
+    cache = ResourceCache.from_alias(cache_dir, argv)
+    if cache is None:
+        return None
+    output = cache.lookup(ttl, stale_ttl, argv)
+    if output is None:
+        return None
+    return output, cache.nodes()
+
+
 if __name__ == "__main__":
-    # Print dict as YAML on stdout
-    print(ResourceGenerator().as_yaml())
+    # Print the resources on stdout
+    STARTED = time.perf_counter()
+    CACHED = _cached_output(sys.argv[1:])
+    if CACHED is None:
+        GENERATOR = ResourceGenerator()
+        if GENERATOR.options.print_mine_config:
+            sys.stdout.write(GENERATOR.mine_config())
+            sys.exit(0)
+        if GENERATOR.options.profiles:
+            FAILED = GENERATOR.write_profiles()
+            GENERATOR.report()
+            sys.exit(1 if FAILED else 0)
+        if GENERATOR.options.listen:
+            ResourceServer(
+                GENERATOR, GENERATOR.options.listen, GENERATOR.options.refresh_interval
+            ).serve_forever()
+            sys.exit(0)
+        if GENERATOR.options.output_file:
+            if GENERATOR.write_file(GENERATOR.options.output_file) is None:
+                sys.exit(1)
+        else:
+            GENERATOR.write(sys.stdout)
+        GENERATOR.report()
+    else:
+        OUTPUT, NODES = CACHED
+        OPTIONS = _scan_options(
+            sys.argv[1:], ("--output-file", "--metrics-file", "--stats-file")
+        )
+        STATS = {
+            "cache_hit": True,
+            "output_sha256": hashlib.sha256(OUTPUT.encode("utf-8")).hexdigest(),
+        }
+        if OPTIONS.get("--output-file"):
+            CHANGED = _write_output_file(OPTIONS["--output-file"], lambda s: s.write(OUTPUT))
+            if CHANGED is None:
+                sys.exit(1)
+            STATS["output_changed"] = CHANGED
+        else:
+            sys.stdout.write(OUTPUT)
+        if OPTIONS.get("--stats-file"):
+            _write_stats(OPTIONS["--stats-file"], STATS)
+        if OPTIONS.get("--metrics-file"):
+            _write_cache_hit_metrics(OPTIONS["--metrics-file"], STARTED, OUTPUT, NODES)
@@ -0,0 +1,714 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmarks for SaltGenResource
+
+Each benchmark prints its results to stdout as a JSON document,
+so that results can be compared from one run to the next.
+
+"""
+
+import argparse
+import contextlib
+import gc
+import getpass
+import json
+import os
+import os.path as path
+import resource
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest.mock import Mock, patch
+
+import yaml
+
+import SaltGenResource
+from SaltGenResource import ResourceCache, ResourceGenerator, SyntheticBackend
+
+BASE_DIR = path.dirname(path.abspath(__file__))
+SCRIPT = path.join(BASE_DIR, "SaltGenResource.py")
+
+
+def time_command(command, repeat):
+    """
+    Run a command repeatedly and summarize its wall time in seconds
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def summarize(samples):
+    """
+    Reduce a list of timing samples to summary statistics
+    """
+    return {
+        "repeat": len(samples),
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.mean(samples),
+    }
+
+
+def peak_rss():
+    """
+    Return the peak resident set size of this process in KiB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_child(*args):
+    """
+    Run a measurement in a fresh interpreter, so that its peak memory use
+    is not affected by earlier measurements, and return its JSON result
+    """
+    result = subprocess.run(
+        [sys.executable, path.abspath(__file__), "--child"] + [str(a) for a in args],
+        check=True,
+        stdout=subprocess.PIPE,
+    )
+    return json.loads(result.stdout)
+
+
+def load_test_data(dataset):
+    """
+    Load a YAML file from the test data directory
+    """
+    with open(path.join(BASE_DIR, "tests", "data", dataset), "r") as stream:
+        return yaml.safe_load(stream)
+
+
+def scaled_mine(count):
+    """
+    Repeat the minions in tests/data/mine.yaml to make a fleet of the given size
+    """
+    template = list(load_test_data("mine.yaml").values())
+    return {
+        "minion{:06d}".format(index): dict(template[index % len(template)])
+        for index in range(count)
+    }
+
+
+class StubParser:
+    """
+    Stand-in for SaltNodesCommandParser that provides options
+    without reading a Salt configuration
+    """
+
+    def __init__(self, **options):
+        values = load_test_data("options.yaml")
+        values.update(options)
+        self.options = argparse.Namespace(**values)
+        self.config = load_test_data("config.yaml")
+        self.args = []
+
+    def __call__(self):
+        return self
+
+    def parse_args(self, *args, **kwargs):  # pylint: disable=unused-argument
+        return self.options, self.args
+
+
+def make_generator(mine=None, **options):
+    """
+    Create a ResourceGenerator for the given mine data without calling
+    the Salt Mine. Without mine data, the backend selected by the options
+    is used, such as backend="synthetic".
+    """
+    if mine is None:
+        with patch("SaltGenResource.SaltNodesCommandParser", StubParser(**options)):
+            return ResourceGenerator()
+    caller = Mock()
+    caller.cmd.return_value = mine
+    caller.sminion.opts = load_test_data("config.yaml")
+    with patch("SaltGenResource.SaltNodesCommandParser", StubParser(**options)):
+        with patch("salt.client.Caller", Mock(return_value=caller)):
+            return ResourceGenerator()
+
+
+def bench_startup(args):
+    """
+    Measure interpreter startup with and without Salt loaded, and the
+    end-to-end time of serving a document from the resource cache
+    """
+    results = {
+        "import": time_command(
+            [sys.executable, "-c", "import SaltGenResource"], args.repeat
+        ),
+        "import_with_salt": time_command(
+            [
+                sys.executable,
+                "-c",
+                "import SaltGenResource; SaltGenResource._load_salt()",
+            ],
+            args.repeat,
+        ),
+    }
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        argv = ["--cache-ttl", "3600", "--cache-dir", cache_dir, "*"]
+        cache = ResourceCache(cache_dir, "benchmark")
+        cache.write("minion1:\n  hostname: minion1.example.com\n")
+        cache.write_alias(argv)
+        results["cache_hit"] = time_command(
+            [sys.executable, SCRIPT] + argv, args.repeat
+        )
+
+    return results
+
+
+def free_port():
+    """
+    Return a TCP port on the loopback interface that is not in use
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition, timeout=60):
+    """
+    Wait until a function returns True, or raise RuntimeError after timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError("Timed out waiting for the test Salt Master")
+        time.sleep(0.1)
+
+
+@contextlib.contextmanager
+def test_master(count):
+    """
+    Run a Salt Master on the loopback interface, with the Salt Mine data of
+    count synthetic minions in its cache, and yield the configuration
+    directory of a minion that can query it
+    """
+    import salt.payload  # pylint: disable=import-outside-toplevel
+
+    with tempfile.TemporaryDirectory() as root:
+        master_dir = path.join(root, "master")
+        minion_dir = path.join(root, "minion")
+        ret_port = free_port()
+        common = {"root_dir": root, "user": getpass.getuser(), "log_level": "quiet"}
+        os.makedirs(master_dir)
+        with open(path.join(master_dir, "master"), "w") as stream:
+            yaml.safe_dump(
+                dict(
+                    common,
+                    interface="127.0.0.1",
+                    publish_port=free_port(),
+                    ret_port=ret_port,
+                    auto_accept=True,
+                ),
+                stream,
+            )
+        os.makedirs(minion_dir)
+        with open(path.join(minion_dir, "minion"), "w") as stream:
+            yaml.safe_dump(
+                dict(common, id="rundeck", master="127.0.0.1", master_port=ret_port),
+                stream,
+            )
+        pki_dir = path.join(root, "etc", "salt", "pki")
+        for directory in ("master/minions", "minion"):
+            os.makedirs(path.join(pki_dir, directory))
+
+        # The master sees minions with accepted keys and mine data
+        mine_dir = path.join(root, "var", "cache", "salt", "master", "mine")
+        os.makedirs(mine_dir)
+        for minion, grains in SyntheticBackend.minions(count).items():
+            with open(path.join(pki_dir, "master", "minions", minion), "w") as stream:
+                stream.write("synthetic minion\n")
+            with open(path.join(mine_dir, minion + ".p"), "wb") as stream:
+                stream.write(salt.payload.dumps({"grains.items": grains}))
+
+        # pylint: disable=consider-using-with
+        master = subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                "import sys, salt.scripts; "
+                "sys.argv = ['salt-master', '-c', sys.argv[1]]; "
+                "salt.scripts.salt_master()",
+                master_dir,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        try:
+
+            def listening():
+                with socket.socket() as sock:
+                    return sock.connect_ex(("127.0.0.1", ret_port)) == 0
+
+            wait_for(listening)
+            yield minion_dir
+        finally:
+            os.killpg(master.pid, signal.SIGTERM)
+            master.wait()
+
+
+def bench_transport(args):
+    """
+    Compare the end-to-end time of generating the resources of synthetic
+    minions from a Salt Master on this host through the Salt Caller,
+    which loads a complete minion, and with the transport backend
+    """
+    results = {}
+    for size in args.sizes or (100, 1000):
+        with test_master(size) as config_dir:
+            results[str(size)] = {}
+            for backend in ("caller", "transport"):
+                command = [
+                    sys.executable,
+                    SCRIPT,
+                    "--config-dir",
+                    config_dir,
+                    "--log-file",
+                    path.join(config_dir, "log"),
+                    "--backend",
+                    backend,
+                    "--include-server-node",
+                    "*",
+                ]
+                # The first run signs in to the master and has its key accepted
+                subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+                results[str(size)][backend] = time_command(command, args.repeat)
+    return results
+
+
+def bench_config(args):
+    """
+    Compare reading the minion configuration, with a growing number of
+    included files, against loading it from the configuration cache
+    """
+    SaltGenResource._load_salt()  # pylint: disable=protected-access
+    results = {}
+    for includes in (0, 10, 50):
+        with tempfile.TemporaryDirectory() as config_dir:
+            config_path = path.join(config_dir, "minion")
+            with open(config_path, "w") as stream:
+                yaml.safe_dump(
+                    {
+                        "master": "salt.example.com",
+                        "root_dir": config_dir,
+                        "file_client": "local",
+                        "log_level_logfile": "info",
+                        "mine_functions": {
+                            "grains.items": [],
+                            "network.ip_addrs": {"interface": "eth0"},
+                        },
+                        "grains": {"roles": ["web", "db"], "datacenter": "dc1"},
+                    },
+                    stream,
+                )
+            os.mkdir(path.join(config_dir, "minion.d"))
+            for index in range(includes):
+                name = path.join(config_dir, "minion.d", "{:02d}.conf".format(index))
+                with open(name, "w") as stream:
+                    yaml.safe_dump({"option_{}".format(index): list(range(10))}, stream)
+            with open(path.join(config_dir, "minion_id"), "w") as stream:
+                stream.write("benchmark")
+
+            def read(config_path=config_path):
+                return SaltGenResource.config.minion_config(
+                    config_path, cache_minion_id=True, ignore_config_errors=False
+                )
+
+            cache = SaltGenResource.ConfigCache(path.join(config_dir, "cache"), config_path)
+            cache.save(read())
+            if cache.load() is None:
+                raise RuntimeError("The configuration cache was not used")
+            results[str(includes)] = {
+                "cold": summarize(time_function(read, args.repeat)),
+                "warm": summarize(time_function(cache.load, args.repeat)),
+            }
+    return results
+
+
+def bench_emit(args):
+    """
+    Compare building the resource dictionary and dumping it with
+    yaml.safe_dump against streaming nodes with and without libyaml
+    """
+    return {
+        str(size): {
+            mode: run_child("emit", mode, size)
+            for mode in ("safe_dump", "stream_libyaml", "stream_emitter")
+        }
+        for size in args.sizes or (1000, 10000, 50000)
+    }
+
+
+def child_emit(mode, size):
+    """
+    Generate YAML for a synthetic fleet in one of the modes compared by bench_emit
+    """
+    generator = make_generator(
+        backend="synthetic",
+        synthetic_count=int(size),
+        stream=mode != "safe_dump",
+        attributes=["os", "os_family", "virtual", "num_cpus"],
+        tags=["roles"],
+    )
+    baseline = peak_rss()
+    with open(os.devnull, "w") as devnull:
+        start = time.perf_counter()
+        if mode == "stream_emitter":
+            with patch.object(yaml, "CSafeDumper", None):
+                generator.write_yaml(devnull)
+        else:
+            generator.write_yaml(devnull)
+        elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "peak_rss_kib": peak_rss(),
+        "added_rss_kib": peak_rss() - baseline,
+    }
+
+
+def bench_formats(args):
+    """
+    Compare the time taken to render each output format
+    """
+    return {
+        str(size): {
+            output_format: run_child("formats", output_format, size)
+            for output_format in ("yaml", "json", "xml")
+        }
+        for size in args.sizes or (1000, 10000, 50000)
+    }
+
+
+def child_formats(output_format, size):
+    """
+    Render the resources for a synthetic fleet in one output format
+    """
+    generator = make_generator(
+        backend="synthetic",
+        synthetic_count=int(size),
+        output_format=output_format,
+        attributes=["os", "os_family", "virtual", "num_cpus"],
+        tags=["roles"],
+    )
+    baseline = peak_rss()
+    start = time.perf_counter()
+    output = generator.render()
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "bytes": len(output.encode("utf-8")),
+        "added_rss_kib": peak_rss() - baseline,
+    }
+
+
+def bench_extract(args):
+    """
+    Compare looking up requested grains with traverse_dict_and_list against
+    the lookups prepared by ResourceGenerator, for tests/data/mine.yaml
+    scaled to 10,000 minions
+    """
+    import salt.utils.data  # pylint: disable=import-outside-toplevel
+
+    attributes = ["os", "os_family", "virtual", "kernelrelease", "instruments:0:1"]
+    tags = ["os", "colors", "instruments:1"]
+    results = {}
+    for size in args.sizes or (10000,):
+        mine = scaled_mine(size)
+        generator = make_generator({}, attributes=attributes, tags=tags)
+        # pylint: disable=protected-access
+        lookups = [lookup for _, _, lookup in generator._attribute_plan] + [
+            lookup for _, lookup in generator._tag_plan
+        ]
+
+        def traverse():
+            for grains in mine.values():
+                for item in attributes:
+                    salt.utils.data.traverse_dict_and_list(grains, item, "", ":")
+                for item in tags:
+                    salt.utils.data.traverse_dict_and_list(grains, item, None, ":")
+
+        def prepared():
+            for grains in mine.values():
+                for lookup in lookups:
+                    lookup(grains)
+
+        def convert():
+            for minion, grains in mine.items():
+                generator._create_attributes(minion, grains)
+                generator._create_tags(minion, grains)
+
+        results[str(size)] = {
+            name: summarize(time_function(function, args.repeat))
+            for name, function in (
+                ("traverse_dict_and_list", traverse),
+                ("prepared_lookups", prepared),
+                ("create_attributes_and_tags", convert),
+            )
+        }
+    return results
+
+
+def bench_workers(args):
+    """
+    Compare converting a synthetic fleet in one process against
+    converting it with a pool of worker processes
+    """
+    results = {"cpu_count": os.cpu_count()}
+    for size in args.sizes or (50000,):
+        mine = SyntheticBackend.minions(size)
+        results[str(size)] = {}
+        for workers in (1, 2, 4, 8):
+            generator = make_generator(
+                {},
+                workers=workers,
+                attributes=[
+                    "os",
+                    "os_family",
+                    "virtual",
+                    "num_cpus",
+                    "mem_total",
+                    "osrelease",
+                    "saltversion",
+                    "locale_info:defaultlanguage",
+                ],
+                tags=["roles", "os", "virtual"],
+            )
+            results[str(size)][str(workers)] = summarize(
+                time_function(
+                    lambda g=generator: g._convert(mine),  # pylint: disable=protected-access
+                    args.repeat,
+                )
+            )
+    return results
+
+
+# Grains requested from every minion by the suite benchmark
+SUITE_ATTRIBUTES = [
+    "os",
+    "os_family",
+    "virtual",
+    "num_cpus",
+    "mem_total",
+    "cpu_model",
+    "kernelversion",
+    "locale_info:defaultlanguage",
+    "instruments:0:1",
+    "ip_interfaces:eth0:0",
+]
+SUITE_TAGS = ["roles", "os", "virtual", "instruments:1"]
+SUITE_STAGES = ("generate", "attributes_tags", "as_yaml")
+
+
+def bench_suite(args):
+    """
+    Time each stage of the generation pipeline for synthetic fleets of
+    100 to 100,000 minions, and measure the memory it allocates. Each stage
+    runs in a fresh interpreter. Option parsing does not depend on the
+    number of minions, and Salt only allows it once per process, so it
+    is measured once per repetition.
+    """
+    samples = [run_child("suite", "parse", 0, 1) for _ in range(args.repeat)]
+    results = {
+        "parse": dict(
+            summarize([sample["seconds"] for sample in samples]),
+            added_rss_kib=max(sample["added_rss_kib"] for sample in samples),
+        )
+    }
+    for size in args.sizes or (100, 1000, 10000, 100000):
+        results[str(size)] = {
+            stage: run_child("suite", stage, size, args.repeat) for stage in SUITE_STAGES
+        }
+    return results
+
+
+def child_suite(stage, size, repeat):
+    """
+    Measure one stage of the generation pipeline for a synthetic fleet
+    """
+    if stage == "parse":
+        with tempfile.TemporaryDirectory() as config_dir:
+            argv = [
+                "--config-dir",
+                config_dir,
+                "--log-file",
+                path.join(config_dir, "log"),
+                "--backend",
+                "synthetic",
+                "--attributes",
+                ",".join(SUITE_ATTRIBUTES),
+                "--tags",
+                ",".join(SUITE_TAGS),
+                "*",
+            ]
+            SaltGenResource._load_salt()  # pylint: disable=protected-access
+            baseline = peak_rss()
+            start = time.perf_counter()
+            SaltGenResource.SaltNodesCommandParser().parse_args(argv)
+            return {
+                "seconds": time.perf_counter() - start,
+                "added_rss_kib": peak_rss() - baseline,
+            }
+
+    generator = make_generator(
+        backend="synthetic",
+        synthetic_count=int(size),
+        attributes=SUITE_ATTRIBUTES,
+        tags=SUITE_TAGS,
+    )
+    # pylint: disable=protected-access
+    mine = generator._backend().mine("*", "glob")
+
+    if stage == "generate":
+
+        def function():
+            generator.resources = {}
+            generator._generate()
+
+    elif stage == "attributes_tags":
+
+        def function():
+            for minion, grains in mine.items():
+                generator._create_attributes(minion, grains)
+                generator._create_tags(minion, grains)
+
+    else:
+        function = generator.as_yaml
+
+    result = summarize(time_function(function, int(repeat)))
+
+    # Trace allocations in a separate run, as tracing slows everything down
+    gc.collect()
+    tracemalloc.start()
+    function()
+    result["peak_traced_kib"] = tracemalloc.get_traced_memory()[1] // 1024
+    tracemalloc.stop()
+    result["peak_rss_kib"] = peak_rss()
+    return result
+
+
+def bench_memory(args):
+    """
+    Compare the memory retained by the node definitions of a synthetic
+    fleet when they are kept as node records and as dictionaries
+    """
+    results = {}
+    for size in args.sizes or (10000, 100000):
+        results[str(size)] = {
+            representation: run_child("memory", representation, size)
+            for representation in ("dicts", "records")
+        }
+    return results
+
+
+def child_memory(representation, size):
+    """
+    Measure the memory retained by the node definitions of a synthetic fleet
+    """
+    generator = make_generator({}, attributes=SUITE_ATTRIBUTES, tags=SUITE_TAGS)
+    if representation == "dicts":
+        compact = lambda self, node: node  # noqa: E731
+    else:
+        compact = SaltGenResource._NodeTable.compact  # pylint: disable=protected-access
+
+    gc.collect()
+    tracemalloc.start()
+    # Decoded mine data holds a copy of every string, like data received from Salt
+    mine = json.loads(json.dumps(SyntheticBackend.minions(int(size))))
+    # pylint: disable=protected-access
+    with patch("SaltGenResource._NodeTable.compact", compact):
+        generator._convert(generator._project(mine, generator._grain_keys))
+    del mine
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "nodes": len(generator.resources),
+        "retained_kib": retained // 1024,
+        "peak_traced_kib": peak // 1024,
+    }
+
+
+def time_function(function, repeat):
+    """
+    Call a function repeatedly and return its wall time samples in seconds
+    """
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+BENCHMARKS = {
+    "config": bench_config,
+    "emit": bench_emit,
+    "extract": bench_extract,
+    "formats": bench_formats,
+    "memory": bench_memory,
+    "startup": bench_startup,
+    "suite": bench_suite,
+    "transport": bench_transport,
+    "workers": bench_workers,
+}
+
+CHILDREN = {
+    "emit": child_emit,
+    "formats": child_formats,
+    "memory": child_memory,
+    "suite": child_suite,
+}
+
+
+def main():
+    """
+    Run the selected benchmarks and print the results as JSON
+    """
+    if len(sys.argv) > 2 and sys.argv[1] == "--child":
+        json.dump(CHILDREN[sys.argv[2]](*sys.argv[3:]), sys.stdout)
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        metavar="benchmark",
+        help="Benchmarks to run: {}. Default: all.".format(", ".join(sorted(BENCHMARKS))),
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=10, help="Repetitions per measurement."
+    )
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        type=int,
+        nargs="+",
+        help="Numbers of synthetic minions to generate.",
+    )
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: {}".format(name))
+
+    results = {
+        "python": sys.version.split()[0],
+        "results": {
+            name: BENCHMARKS[name](args) for name in args.benchmarks or sorted(BENCHMARKS)
+        },
+    }
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
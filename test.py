@@ -1,13 +1,41 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import os
 import os.path as path
 import argparse
+import fcntl
+import tempfile
+import threading
+import time
+import io
+import hashlib
+import json
+import logging
+import runpy
+import urllib.request
+import urllib.error
 from unittest import TestCase, TextTestRunner, main
 
 import yaml
+import salt.payload
 import salt.version as version
-from SaltGenResource import ResourceGenerator, SaltNodesCommandParser
+from SaltGenResource import (
+    ConfigCache,
+    ResourceCache,
+    ResourceGenerator,
+    ResourceServer,
+    SaltNodesCommandParser,
+    SyntheticBackend,
+    _cached_output,
+    _emit_node,
+    _grain_lookup,
+    _load_document,
+    _load_salt,
+    _match_target,
+    _NodeRecord,
+    _NodeTable,
+)
 
 from unittest.mock import patch, Mock
 
@@ -86,6 +114,19 @@ class TestNodeGenerator(TestCase):
                 self._test_attributes(resources, parser.options.attributes)
                 caller.cmd.assert_called_once_with(*self.default_args, **call_kwargs)
 
+    def test_parsed_option_sets(self):
+        # The command line parser stores --attributes and --tags as sets
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()):
+                parser.options.include_server_node = self.include_server_node
+                parser.options.attributes = SaltNodesCommandParser.split_values("os,os_family")
+                parser.options.tags = SaltNodesCommandParser.split_values("colors")
+                resources = ResourceGenerator().as_dict()
+
+                self._test_required_attributes(resources)
+                self._test_attributes(resources, parser.options.attributes)
+                self.assertEqual(sorted(resources["winmin"]["tags"]), ["green", "red"])
+
     def test_list_attribute(self):
         with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
             with patch("salt.client.Caller", MockCaller()) as caller:
@@ -292,6 +333,1634 @@ class TestServerNodeGenerator(TestNodeGenerator):
     include_server_node = True
 
 
+class TestResourceCache(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.cache_dir.cleanup)
+
+    def _generate(self, parser, ttl=60, stale_ttl=0):
+        parser.options.cache_ttl = ttl
+        parser.options.cache_stale_ttl = stale_ttl
+        parser.options.cache_dir = self.cache_dir.name
+        parser.options.attributes = ["os"]
+        return ResourceGenerator()
+
+    def test_cache_hit(self):
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()) as caller:
+                first = self._generate(parser).as_yaml()
+                second = self._generate(parser)
+                self.assertEqual(second.as_yaml(), first)
+                self.assertEqual(second.as_dict()["linmin"]["os"], "RedHat")
+                caller.cmd.assert_called_once()
+
+    def test_cache_expired(self):
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()) as caller:
+                self._generate(parser)
+                for entry in os.listdir(self.cache_dir.name):
+                    stale = time.time() - 120
+                    os.utime(path.join(self.cache_dir.name, entry), (stale, stale))
+                self._generate(parser)
+                self.assertEqual(caller.cmd.call_count, 2)
+
+    def test_cache_stale_while_revalidate(self):
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()) as caller:
+                with patch("SaltGenResource.ResourceCache.start_refresh") as refresh:
+                    first = self._generate(parser).as_yaml()
+                    for entry in os.listdir(self.cache_dir.name):
+                        stale = time.time() - 120
+                        os.utime(path.join(self.cache_dir.name, entry), (stale, stale))
+                    second = self._generate(parser, stale_ttl=600)
+                    self.assertEqual(second.as_yaml(), first)
+                    caller.cmd.assert_called_once()
+                    refresh.assert_called_once()
+
+    def test_cached_output_without_salt(self):
+        argv = ["--cache-ttl", "60", "--cache-dir", self.cache_dir.name, "*"]
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()):
+                parser.options.cache_ttl = 60
+                parser.options.cache_dir = self.cache_dir.name
+                expected = ResourceGenerator(argv).as_yaml()
+
+        self.assertEqual(_cached_output(argv), (expected, 2))
+        self.assertIsNone(_cached_output(argv + ["--help"]))
+        self.assertIsNone(_cached_output(argv[2:]))
+        # The default location is only known from the minion configuration
+        self.assertIsNone(_cached_output(argv[:2] + argv[4:]))
+        self.assertIsNone(_cached_output(argv[:-1] + ["web*"]))
+
+    def test_key_is_order_independent(self):
+        self.assertEqual(
+            ResourceCache.make_key(tgt="*", attributes={"os", "kernel"}),
+            ResourceCache.make_key(tgt="*", attributes={"kernel", "os"}),
+        )
+        self.assertNotEqual(
+            ResourceCache.make_key(tgt="*", attributes={"os"}),
+            ResourceCache.make_key(tgt="web*", attributes={"os"}),
+        )
+
+
+class TestConfigCache(TestCase):
+    def setUp(self):
+        _load_salt()
+        self.config_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.config_dir.cleanup)
+        self.config_path = path.join(self.config_dir.name, "minion")
+        self._write("minion", "id: test\n")
+        os.mkdir(path.join(self.config_dir.name, "minion.d"))
+        self.cache = ConfigCache(path.join(self.config_dir.name, "cache"), self.config_path)
+        self.config = {
+            "id": "test",
+            "conf_file": self.config_path,
+            "default_include": "minion.d/*.conf",
+            "include": [],
+        }
+
+    def _write(self, name, content):
+        with open(path.join(self.config_dir.name, name), "w") as stream:
+            stream.write(content)
+
+    def test_invalidation(self):
+        self.assertIsNone(self.cache.load())
+        self.cache.save(self.config)
+        self.assertEqual(self.cache.load(), self.config)
+
+        # A new include
+        self._write("minion.d/extra.conf", "grains: {}\n")
+        self.assertIsNone(self.cache.load())
+        self.cache.save(self.config)
+        self.assertEqual(self.cache.load(), self.config)
+
+        # A changed configuration file
+        self._write("minion", "id: other\n")
+        self.assertIsNone(self.cache.load())
+        self.cache.save(self.config)
+
+        # A new cached minion ID
+        self._write("minion_id", "test")
+        self.assertIsNone(self.cache.load())
+
+    def test_unsafe(self):
+        self.cache.save(self.config)
+        os.chmod(self.cache.path, 0o666)
+        with self.assertLogs("salt-gen-resource", "WARNING"):
+            self.assertIsNone(self.cache.load())
+
+
+class TestResourceServer(TestCase):
+    def setUp(self):
+        patcher = patch("SaltGenResource.SaltNodesCommandParser", MockParser())
+        self.parser = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("salt.client.Caller", MockCaller())
+        self.caller = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.parser.options.attributes = ["os"]
+        self.server = ResourceServer(ResourceGenerator(), ("127.0.0.1", 0), 3600)
+        thread = threading.Thread(target=self.server.httpd.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.httpd.server_close)
+        self.addCleanup(self.server.httpd.shutdown)
+
+    def _get(self, path, headers=None):
+        url = "http://127.0.0.1:{}{}".format(self.server.httpd.server_address[1], path)
+        request = urllib.request.Request(url, headers=headers or {})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.headers, b""
+
+    def test_ipv6(self):
+        server = ResourceServer(self.server.generator, ("::1", 0), 3600)
+        self.addCleanup(server.httpd.server_close)
+        thread = threading.Thread(target=server.httpd.serve_forever, daemon=True)
+        thread.start()
+        url = "http://[::1]:{}/resources.json".format(server.httpd.server_address[1])
+        with urllib.request.urlopen(url) as response:
+            self.assertEqual(json.loads(response.read())["winmin"]["os"], "Windows")
+        server.httpd.shutdown()
+
+    def test_yaml(self):
+        status, headers, body = self._get("/resources.yaml")
+        self.assertEqual(status, 200)
+        self.assertTrue(headers["Content-Type"].startswith("text/yaml"))
+        self.assertEqual(yaml.safe_load(body)["linmin"]["os"], "RedHat")
+
+    def test_json(self):
+        status, headers, body = self._get("/", {"Accept": "application/json"})
+        self.assertEqual(status, 200)
+        self.assertTrue(headers["Content-Type"].startswith("application/json"))
+        self.assertEqual(json.loads(body)["winmin"]["os"], "Windows")
+
+    def test_not_modified(self):
+        _, headers, _ = self._get("/resources.yaml")
+        status, _, body = self._get("/resources.yaml", {"If-None-Match": headers["ETag"]})
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+
+    def test_refresh(self):
+        _, headers, _ = self._get("/resources.yaml")
+        self.caller.cmd.return_value = {"linmin": load_test_data("mine.yaml")["linmin"]}
+        self.server.refresh()
+        self.assertEqual(self.caller.cmd.call_count, 2)
+        status, _, body = self._get("/resources.yaml", {"If-None-Match": headers["ETag"]})
+        self.assertEqual(status, 200)
+        self.assertNotIn("winmin", yaml.safe_load(body))
+
+    def test_render_on_request(self):
+        # Only the --output-format document is rendered with each refresh
+        self.assertEqual(list(self.server.documents), ["yaml"])
+        _, _, body = self._get("/resources.json")
+        self.assertIn("winmin", json.loads(body))
+        self.assertEqual(sorted(self.server.documents), ["json", "yaml"])
+
+        self.caller.cmd.return_value = {"linmin": load_test_data("mine.yaml")["linmin"]}
+        self.server.refresh()
+        self.assertEqual(list(self.server.documents), ["yaml"])
+        _, _, body = self._get("/resources.json")
+        self.assertNotIn("winmin", json.loads(body))
+
+    def test_not_found(self):
+        status, _, _ = self._get("/missing")
+        self.assertEqual(status, 404)
+
+
+class TestGrainLookup(TestCase):
+    grains = {
+        "os": "RedHat",
+        "locale_info": {"defaultlanguage": "en_US"},
+        "colors": ["red", "green"],
+        "disks": [{"name": "sda"}, {"name": "sdb"}],
+        "numbers": {1: "one"},
+        "virtual": False,
+    }
+
+    def test_matches_traverse_dict_and_list(self):
+        import salt.utils.data  # pylint: disable=import-outside-toplevel
+
+        items = [
+            "os",
+            "locale_info:defaultlanguage",
+            "locale_info:missing",
+            "colors:1",
+            "colors:5",
+            "colors:²",
+            "colors:+1",
+            "colors:-1",
+            "disks:name",
+            "numbers:1",
+            "virtual",
+            "os:0",
+            "missing",
+        ]
+        for item in items:
+            for default in ("", None):
+                self.assertEqual(
+                    _grain_lookup(item, ":", default)(self.grains),
+                    salt.utils.data.traverse_dict_and_list(
+                        self.grains, item, default=default
+                    ),
+                    item,
+                )
+
+    def test_delimiter(self):
+        self.assertEqual(
+            _grain_lookup("locale_info|defaultlanguage", "|", None)(self.grains), "en_US"
+        )
+
+
+class TestStreaming(TestCase):
+    def _generate(self, stream, include_server_node=False):
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()):
+                parser.options.stream = stream
+                parser.options.include_server_node = include_server_node
+                parser.options.attributes = ["os", "virtual"]
+                parser.options.tags = ["colors"]
+                parser.args = ["pattern='polka dot'", "version=1.0"]
+                generator = ResourceGenerator()
+                output = io.StringIO()
+                generator.write_yaml(output)
+                return output.getvalue()
+
+    def test_stream_matches_safe_dump(self):
+        for include_server_node in (False, True):
+            expected = self._generate(False, include_server_node)
+            self.assertEqual(self._generate(True, include_server_node), expected)
+
+    def test_stream_without_libyaml(self):
+        expected = yaml.safe_load(self._generate(False, True))
+        with patch.object(yaml, "CSafeDumper", None):
+            output = self._generate(True, True)
+        self.assertEqual(yaml.safe_load(output), expected)
+
+    def test_emit_node_quoting(self):
+        node = {
+            "plain": "RedHat",
+            "boolean": "yes",
+            "version": "4.4.0-75-generic",
+            "number": "42",
+            "empty": "",
+            "colon": "a: b",
+            "comment": "a #b",
+            "quote": 'say "hi"',
+            "newline": "one\ntwo",
+            "false": False,
+            "count": 3,
+            "tags": ["null", "web", "-dash"],
+        }
+        self.assertEqual(yaml.safe_load(_emit_node("node1", node)), {"node1": node})
+        self.assertIsNone(_emit_node("node1", {"ratio": 0.5}))
+        self.assertIsNone(_emit_node("node1", {"name": "⋐⊮⊰⟒"}))
+
+
+class TestOutputFormats(TestCase):
+    def _generate(self, output_format, stream=False):
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()):
+                parser.options.output_format = output_format
+                parser.options.stream = stream
+                parser.options.include_server_node = True
+                parser.options.attributes = ["os", "virtual"]
+                parser.options.tags = ["colors"]
+                parser.args = ["pattern=<polka & \"dot\">"]
+                generator = ResourceGenerator()
+                output = io.StringIO()
+                generator.write(output)
+                return generator, output.getvalue()
+
+    def test_json(self):
+        generator, output = self._generate("json")
+        self.assertEqual(json.loads(output), generator.as_dict())
+        self.assertEqual(self._generate("json", stream=True)[1], output)
+
+    def test_xml(self):
+        generator, output = self._generate("xml")
+        self.assertTrue(output.startswith("<?xml"))
+        self.assertEqual(self._generate("xml", stream=True)[1], output)
+
+        resources = _load_document(output, "xml")
+        expected = generator.as_dict()
+        self.assertEqual(sorted(resources), sorted(expected))
+        for name, node in expected.items():
+            self.assertEqual(resources[name]["hostname"], node["hostname"])
+            self.assertEqual(resources[name]["osArch"], node["osArch"])
+            self.assertEqual(resources[name]["pattern"], node["pattern"])
+            self.assertEqual(resources[name]["virtual"], "false")
+            self.assertEqual(sorted(resources[name]["tags"]), sorted(node["tags"]))
+
+    def test_render(self):
+        generator, output = self._generate("xml")
+        self.assertEqual(generator.render(), output)
+        self.assertEqual(yaml.safe_load(generator.as_yaml()), generator.as_dict())
+
+
+class TestLibrary(TestCase):
+    def test_generate(self):
+        mine = load_test_data("mine.yaml")
+        caller = MockCaller()
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", Mock(return_value=caller)) as factory:
+                parser.options.attributes = ["os"]
+                generator = ResourceGenerator(generate=False)
+                caller.cmd.assert_not_called()
+                self.assertEqual(generator.resources, {})
+
+                first = generator.generate()
+                self.assertEqual(set(first), set(mine))
+                for node in first.values():
+                    node["os"] = "changed"
+
+                # Each call returns a new result from a new Salt Mine call
+                del mine["linmin"]
+                caller.cmd.return_value = mine
+                second = generator.generate()
+                self.assertEqual(set(second), set(mine))
+                for name, node in second.items():
+                    self.assertEqual(node["os"], mine[name]["os"])
+                self.assertEqual(caller.cmd.call_count, 2)
+                self.assertEqual(generator._counts["minions"], len(mine))
+                factory.assert_called_once()
+
+                # Other instances have their own resources
+                self.assertEqual(ResourceGenerator(generate=False).resources, {})
+
+
+class TestTargetSpecs(TestCase):
+    def test_merge(self):
+        mine = load_test_data("mine.yaml")
+        names = sorted(mine)
+        results = {
+            "web*": {name: mine[name] for name in names[:2]},
+            "G@virtual:kvm": {name: mine[name] for name in names[1:]},
+        }
+        # The Caller is not thread-safe, so calls must not overlap
+        active = []
+
+        def cmd(function, tgt, *args, **kwargs):  # pylint: disable=unused-argument
+            active.append(tgt)
+            time.sleep(0.05)
+            self.assertEqual(active, [tgt])
+            active.remove(tgt)
+            return results[tgt]
+
+        caller = MockCaller()
+        caller.cmd.side_effect = cmd
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", caller):
+                parser.config["targets"] = [("web*", "glob"), ("G@virtual:kvm", "compound")]
+                generator = ResourceGenerator()
+
+        self.assertEqual(sorted(generator.as_dict()), names)
+        self.assertEqual(generator._counts["minions"], len(names))
+        self.assertEqual(
+            [(t["tgt"], t["tgt_type"], t["minions"]) for t in generator.stats["targets"]],
+            [("web*", "glob", 2), ("G@virtual:kvm", "compound", len(names) - 1)],
+        )
+        for target in generator.stats["targets"]:
+            self.assertGreater(target["seconds"], 0)
+
+    def test_concurrent_backend(self):
+        # Both calls must be waiting at the same time
+        barrier = threading.Barrier(2, timeout=5)
+        mine = SyntheticBackend.mine
+
+        def wait_and_mine(backend, tgt, tgt_type):
+            barrier.wait()
+            return mine(backend, tgt, tgt_type)
+
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch.object(SyntheticBackend, "mine", wait_and_mine):
+                parser.options.backend = "synthetic"
+                parser.options.synthetic_count = 20
+                parser.config["targets"] = [
+                    ("minion00000[0-1]", "glob"),
+                    ("minion00001[0-1]", "glob"),
+                ]
+                generator = ResourceGenerator()
+        self.assertEqual(len(generator.as_dict()), 4)
+
+    def test_local_backend(self):
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            parser.options.backend = "synthetic"
+            parser.options.synthetic_count = 20
+            parser.config["targets"] = [
+                ("minion00000[0-4]", "glob"),
+                (["minion000003", "minion000012"], "list"),
+            ]
+            generator = ResourceGenerator()
+        self.assertEqual(
+            sorted(generator.as_dict()),
+            ["minion00000{}".format(n) for n in range(5)] + ["minion000012"],
+        )
+
+
+class TestFallback(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _generate(self, mine=None, error=None, **options):
+        caller = MockCaller()
+        if mine is not None:
+            caller.cmd.return_value = mine
+        caller.cmd.side_effect = error
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", caller):
+                parser.options.fallback = True
+                parser.options.cache_dir = self.tmpdir.name
+                parser.options.attributes = ["os"]
+                vars(parser.options).update(options)
+                return ResourceGenerator()
+
+    def test_error(self):
+        expected = self._generate().as_yaml()
+        self.assertNotIn("fallback", self._generate().stats)
+
+        generator = self._generate(error=RuntimeError("Master unreachable"))
+        self.assertEqual(generator.as_yaml(), expected)
+        self.assertEqual(generator.as_dict()["linmin"]["os"], "RedHat")
+        self.assertEqual(generator.stats["fallback"]["reason"], "Master unreachable")
+        self.assertGreaterEqual(generator.stats["fallback"]["age_seconds"], 0)
+
+    def test_no_last_good_output(self):
+        with self.assertRaises(RuntimeError):
+            self._generate(error=RuntimeError("Master unreachable"))
+
+    def _hang(self, calls):
+        """
+        Return a Salt Mine call that does not return before the test ends
+        """
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def hang(*args, **kwargs):  # pylint: disable=unused-argument
+            calls.append(args)
+            release.wait(10)
+
+        return hang
+
+    def test_fetch_timeout(self):
+        expected = self._generate().as_yaml()
+        with patch.object(ResourceGenerator, "_abandoned_fetches", []):
+            generator = self._generate(error=self._hang([]), fetch_timeout=0.1)
+        self.assertEqual(generator.as_yaml(), expected)
+        self.assertIn("0.1 seconds", generator.stats["fallback"]["reason"])
+        # The backend of the abandoned call is not used again
+        self.assertIsNone(generator.backend)
+
+    def test_abandoned_fetches_capped(self):
+        expected = self._generate().as_yaml()
+        calls = []
+        with patch.object(ResourceGenerator, "_abandoned_fetches", []):
+            with patch.object(ResourceGenerator, "_max_abandoned_fetches", 1):
+                self._generate(error=self._hang(calls), fetch_timeout=0.1)
+                generator = self._generate(error=self._hang(calls), fetch_timeout=0.1)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(generator.as_yaml(), expected)
+        self.assertIn("still running", generator.stats["fallback"]["reason"])
+
+    def test_other_errors(self):
+        self._generate()
+        with patch.object(ResourceGenerator, "render", side_effect=RuntimeError("Bug")):
+            with self.assertRaisesRegex(RuntimeError, "Bug"):
+                self._generate()
+
+    def test_empty_result_not_kept(self):
+        self._generate({})
+        with self.assertRaises(RuntimeError):
+            self._generate(error=RuntimeError("Master unreachable"))
+
+    def test_max_node_drop(self):
+        mine = load_test_data("mine.yaml")
+        expected = self._generate(max_node_drop=25).as_yaml()
+
+        # Losing more than a quarter of the nodes is refused
+        fewer = dict(list(mine.items())[: len(mine) // 2])
+        generator = self._generate(fewer, max_node_drop=25)
+        self.assertEqual(generator.as_yaml(), expected)
+        self.assertIn("--max-node-drop", generator.stats["fallback"]["reason"])
+
+        generator = self._generate(fewer, max_node_drop=75)
+        self.assertNotIn("fallback", generator.stats)
+        self.assertEqual(set(generator.as_dict()), set(fewer))
+
+    def test_metrics(self):
+        metrics_file = path.join(self.tmpdir.name, "metrics.prom")
+        self._generate()
+        generator = self._generate(
+            error=RuntimeError("Master unreachable"), metrics_file=metrics_file
+        )
+        generator.write_metrics()
+        with open(metrics_file) as stream:
+            metrics = stream.read()
+        self.assertIn("salt_gen_resource_fallback 1\n", metrics)
+
+
+class TestCanonical(TestCase):
+    def _write(self, mine, output_format="yaml", args="", **options):
+        caller = MockCaller()
+        caller.cmd.return_value = mine
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", caller):
+                parser.args = args
+                parser.options.canonical = True
+                parser.options.output_format = output_format
+                parser.options.attributes = ["os", "num_cpus"]
+                parser.options.tags = ["colors", "os"]
+                vars(parser.options).update(options)
+                generator = ResourceGenerator()
+                stream = io.StringIO()
+                generator.write(stream)
+        return generator, stream.getvalue()
+
+    def test_stable_output(self):
+        mine = load_test_data("mine.yaml")
+        for grains in mine.values():
+            grains["num_cpus"] = 4
+        reordered = {}
+        for name in reversed(list(mine)):
+            grains = dict(mine[name])
+            if isinstance(grains.get("colors"), list):
+                grains["colors"] = list(reversed(grains["colors"]))
+            reordered[name] = grains
+
+        for output_format in ("yaml", "json", "xml"):
+            for stream in (False, True):
+                generator, output = self._write(mine, output_format, stream=stream)
+                other, other_output = self._write(reordered, output_format, stream=stream)
+                self.assertEqual(output, other_output)
+                self.assertEqual(
+                    generator.stats["output_sha256"],
+                    hashlib.sha256(output.encode("utf-8")).hexdigest(),
+                )
+                self.assertEqual(
+                    generator.stats["output_sha256"], other.stats["output_sha256"]
+                )
+
+        generator, _ = self._write(reordered)
+        self.assertEqual(list(generator.resources), sorted(mine))
+        for node in generator.resources.values():
+            self.assertEqual(node["num_cpus"], "4")
+            self.assertEqual(node["tags"], sorted(node["tags"]))
+
+    def test_values(self):
+        mine = load_test_data("mine.yaml")
+        mine["linmin"].update(num_cpus=4, selinux_enabled=True)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            metrics_file = path.join(tmpdir, "metrics.prom")
+            generator, _ = self._write(
+                mine,
+                args=["nested=[[1], {b: 2, a: 1}]"],
+                attributes=["num_cpus", "selinux_enabled"],
+                metrics_file=metrics_file,
+            )
+            generator.write_metrics()
+            with open(metrics_file) as stream:
+                metrics = stream.read()
+        node = generator.resources["linmin"]
+        self.assertEqual(node["num_cpus"], "4")
+        self.assertEqual(node["selinux_enabled"], "true")
+        self.assertEqual(node["nested"], '[[1], {"a": 1, "b": 2}]')
+        # The hash is in the statistics, not in a label of its own series
+        self.assertNotIn(generator.stats["output_sha256"], metrics)
+
+
+class TestOutputFile(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.output_file = path.join(self.tmpdir.name, "nodes", "resources.yaml")
+
+    def _write_file(self, mine=None):
+        caller = MockCaller()
+        if mine is not None:
+            caller.cmd.return_value = mine
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", caller):
+                parser.options.attributes = ["os"]
+                generator = ResourceGenerator()
+                changed = generator.write_file(self.output_file)
+        return generator, changed
+
+    def test_write_if_changed(self):
+        generator, changed = self._write_file()
+        self.assertTrue(changed)
+        with open(self.output_file) as stream:
+            self.assertEqual(stream.read(), generator.as_yaml())
+        os.utime(self.output_file, (1000000000, 1000000000))
+        inode = os.stat(self.output_file).st_ino
+
+        # Unchanged output leaves the file alone
+        generator, changed = self._write_file()
+        self.assertFalse(changed)
+        self.assertFalse(generator.stats["output_changed"])
+        self.assertEqual(os.stat(self.output_file).st_mtime, 1000000000)
+        self.assertEqual(os.stat(self.output_file).st_ino, inode)
+        self.assertEqual(os.listdir(path.dirname(self.output_file)), ["resources.yaml"])
+
+        mine = load_test_data("mine.yaml")
+        mine["linmin"]["os"] = "Fedora"
+        generator, changed = self._write_file(mine)
+        self.assertTrue(changed)
+        self.assertNotEqual(os.stat(self.output_file).st_mtime, 1000000000)
+        with open(self.output_file) as stream:
+            self.assertEqual(yaml.safe_load(stream)["linmin"]["os"], "Fedora")
+
+    def test_unwritable(self):
+        # The parent of the output file is a regular file
+        with open(path.join(self.tmpdir.name, "nodes"), "w"):
+            pass
+        with self.assertLogs("salt-gen-resource", "ERROR") as logs:
+            generator, changed = self._write_file()
+        self.assertIsNone(changed)
+        self.assertNotIn("output_changed", generator.stats)
+        self.assertIn("Unable to write the resources", logs.output[0])
+
+        # Served from the resource cache, without loading Salt
+        cache_dir = path.join(self.tmpdir.name, "cache")
+        argv = ["--cache-ttl", "60", "--cache-dir", cache_dir, "--output-file", self.output_file, "*"]
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()):
+                parser.options.cache_ttl = 60
+                parser.options.cache_dir = cache_dir
+                ResourceGenerator(argv).write(io.StringIO())
+        script = path.join(path.dirname(path.abspath(__file__)), "SaltGenResource.py")
+        with patch("sys.argv", [script] + argv), self.assertLogs("salt-gen-resource", "ERROR") as logs:
+            with self.assertRaises(SystemExit) as exc:
+                runpy.run_path(script, run_name="__main__")
+        self.assertEqual(exc.exception.code, 1)
+        self.assertIn("Unable to write the resources", logs.output[0])
+
+
+class TestSingleFlight(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _follow(self, leader_output, wait=5, release=True):
+        """
+        Start a run while another run with the same options holds the lock,
+        and let that run store leader_output, or fail if it is None. Unless
+        release is False, the lock is then released.
+        """
+        waiting = threading.Event()
+        flock = fcntl.flock
+
+        def try_lock(fd, operation):
+            try:
+                return flock(fd, operation)
+            except BlockingIOError:
+                waiting.set()
+                raise
+
+        result = {}
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()) as caller:
+                parser.options.single_flight = wait
+                parser.options.cache_dir = self.tmpdir.name
+                leader = ResourceGenerator(generate=False)._single_flight()
+                self.assertIsNone(leader.join(0))
+                with patch("fcntl.flock", try_lock):
+                    thread = threading.Thread(
+                        target=lambda: result.update(generator=ResourceGenerator())
+                    )
+                    thread.start()
+                    self.assertTrue(waiting.wait(5))
+                    if leader_output is not None:
+                        leader.write(leader_output)
+                    if release:
+                        leader.release()
+                    thread.join()
+                leader.release()
+        return result["generator"], caller
+
+    def test_reuse(self):
+        generator, caller = self._follow("shared: {}\n")
+        caller.cmd.assert_not_called()
+        self.assertEqual(generator.as_yaml(), "shared: {}\n")
+        self.assertTrue(generator.stats["single_flight"]["shared"])
+
+    def test_leader_failed(self):
+        generator, caller = self._follow(None)
+        caller.cmd.assert_called_once()
+        self.assertIn("linmin", generator.as_dict())
+        self.assertFalse(generator.stats["single_flight"]["shared"])
+
+    def test_timeout(self):
+        with self.assertLogs("salt-gen-resource", "WARNING") as logs:
+            generator, caller = self._follow(None, wait=0.2, release=False)
+        caller.cmd.assert_called_once()
+        self.assertIn("linmin", generator.as_dict())
+        self.assertIn("Gave up waiting 0.2 seconds", logs.output[0])
+
+    def test_unusable_cache_dir(self):
+        # The cache directory is a regular file
+        cache_dir = path.join(self.tmpdir.name, "cache")
+        with open(cache_dir, "w"):
+            pass
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()) as caller:
+                parser.options.single_flight = 5
+                parser.options.cache_dir = cache_dir
+                with self.assertLogs("salt-gen-resource", "WARNING") as logs:
+                    generator = ResourceGenerator()
+        caller.cmd.assert_called_once()
+        self.assertIn("linmin", generator.as_dict())
+        self.assertFalse(generator.stats["single_flight"]["shared"])
+        self.assertIn("Not waiting for concurrent runs", logs.output[0])
+
+
+class TestWorkers(TestCase):
+    def _generate(self, workers, stream=False):
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()):
+                parser.options.workers = workers
+                parser.options.stream = stream
+                parser.options.include_server_node = True
+                parser.options.attributes = ["os", "virtual"]
+                parser.options.tags = ["colors", "os", "missing"]
+                parser.args = ["pattern='polka dot'"]
+                with self.assertLogs("salt-gen-resource", "WARNING") as logs:
+                    generator = ResourceGenerator()
+                    output = io.StringIO()
+                    generator.write_yaml(output)
+                return output.getvalue(), logs.output
+
+    def test_workers_match_serial(self):
+        for stream in (False, True):
+            expected, expected_logs = self._generate(1, stream)
+            output, output_logs = self._generate(3, stream)
+            self.assertEqual(output, expected)
+            self.assertEqual(output_logs, expected_logs)
+
+
+class TestIncremental(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.mine = load_test_data("mine.yaml")
+
+    def _generate(self, incremental=True, canonical=False):
+        caller = MockCaller()
+        caller.cmd.return_value = self.mine
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", caller):
+                parser.options.incremental = incremental
+                parser.options.canonical = canonical
+                parser.options.cache_dir = self.tmpdir.name
+                parser.options.stats_file = path.join(self.tmpdir.name, "stats.json")
+                parser.options.attributes = ["os", "virtual"]
+                parser.options.tags = ["colors"]
+                parser.args = ["pattern='polka dot'"]
+                generator = ResourceGenerator()
+                generator.write_stats()
+                return generator
+
+    def _stats(self):
+        with open(path.join(self.tmpdir.name, "stats.json")) as stream:
+            return json.load(stream)
+
+    def test_reuse_unchanged_nodes(self):
+        expected = self._generate(False).as_yaml()
+        count = len(self.mine)
+
+        self.assertEqual(self._generate().as_yaml(), expected)
+        self.assertEqual(
+            self._stats()["nodes"], {"reused": 0, "rebuilt": count, "removed": 0}
+        )
+
+        self.assertEqual(self._generate().as_yaml(), expected)
+        self.assertEqual(
+            self._stats()["nodes"], {"reused": count, "rebuilt": 0, "removed": 0}
+        )
+
+    def test_rebuild_changed_nodes(self):
+        self._generate()
+        first, second = sorted(self.mine)[:2]
+        self.mine[first] = dict(self.mine[first], os="Plan9")
+        del self.mine[second]
+        # Grains that are not used by the node definition are ignored
+        for grains in self.mine.values():
+            grains["unused"] = "changed"
+
+        generator = self._generate()
+        self.assertEqual(generator.resources[first]["os"], "Plan9")
+        self.assertNotIn(second, generator.resources)
+        self.assertEqual(
+            self._stats()["nodes"],
+            {"reused": len(self.mine) - 1, "rebuilt": 1, "removed": 1},
+        )
+        self.assertEqual(generator.as_yaml(), self._generate(False).as_yaml())
+
+    def test_canonical(self):
+        for grains in self.mine.values():
+            grains["virtual"] = True
+        self._generate()
+        generator = self._generate(canonical=True)
+        # Nodes stored without --canonical are not reused
+        self.assertEqual(self._stats()["nodes"]["reused"], 0)
+        self.assertEqual(generator.as_dict()["linmin"]["virtual"], "true")
+        generator = self._generate(canonical=True)
+        self.assertEqual(self._stats()["nodes"]["reused"], len(self.mine))
+        self.assertEqual(generator.as_dict()["linmin"]["virtual"], "true")
+
+    def test_static_attributes_change_key(self):
+        self._generate()
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()):
+                parser.options.incremental = True
+                parser.options.cache_dir = self.tmpdir.name
+                parser.options.attributes = ["os", "virtual"]
+                parser.options.tags = ["colors"]
+                parser.args = ["pattern=stripes"]
+                generator = ResourceGenerator()
+        self.assertEqual(generator.stats["nodes"]["reused"], 0)
+
+
+class TestProjection(TestCase):
+    def _generator(self, **options):
+        caller = MockCaller()
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", caller):
+                parser.options.attributes = ["os", "locale_info:defaultlanguage"]
+                parser.options.tags = ["colors"]
+                vars(parser.options).update(options)
+                return ResourceGenerator(), caller.cmd.return_value
+
+    def test_unused_grains_discarded(self):
+        expected = {
+            "colors",
+            "cpuarch",
+            "fqdn",
+            "kernel",
+            "kernelrelease",
+            "locale_info",
+            "os",
+        }
+        generator, mine = self._generator()
+        for grains in mine.values():
+            self.assertLessEqual(set(grains), expected)
+        self.assertNotIn("grains", generator.stats)
+
+        # The nodes are the same as those converted from all grains
+        projected = generator.resources
+        generator._convert(load_test_data("mine.yaml"))
+        self.assertEqual(projected, generator.resources)
+
+    def test_bytes_reported(self):
+        generator, _ = self._generator(stats_file="-")
+        stats = generator.stats["grains"]
+        self.assertGreater(stats["received_bytes"], stats["retained_bytes"])
+        self.assertGreater(stats["retained_bytes"], 0)
+
+    def test_mine_config(self):
+        generator, _ = self._generator(print_mine_config=True)
+        config = yaml.safe_load(generator.mine_config())
+        self.assertEqual(
+            config["mine_functions"]["rundeck_grains"],
+            [
+                {"mine_function": "grains.item"},
+                "colors",
+                "cpuarch",
+                "fqdn",
+                "kernel",
+                "kernelrelease",
+                "locale_info",
+                "os",
+            ],
+        )
+        self.assertEqual(generator.resources, {})
+
+
+class TestNodeRecords(TestCase):
+    def _generator(self, **options):
+        caller = MockCaller()
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", caller):
+                parser.options.attributes = ["os", "os_family"]
+                parser.options.tags = ["colors", "os"]
+                parser.args = ["site=east"]
+                vars(parser.options).update(options)
+                return ResourceGenerator()
+
+    def test_compact(self):
+        table = _NodeTable()
+        first = table.compact({"osName": "Linux", "tags": ["a", "b"], "cpus": 1})
+        second = table.compact(
+            {"osName": "".join(["Lin", "ux"]), "tags": ["a", "b"], "cpus": True}
+        )
+        self.assertEqual(first, {"osName": "Linux", "tags": ["a", "b"], "cpus": 1})
+        self.assertIs(first._index, second._index)
+        self.assertIs(first._values[0], second._values[0])
+        self.assertIs(first._values[1], second._values[1])
+        self.assertIs(second["cpus"], True)
+        self.assertIs(table.compact(first), first)
+        with self.assertRaises(KeyError):
+            first["missing"]  # pylint: disable=pointless-statement
+
+    def test_nested_static_values(self):
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()):
+                parser.args = ["nested=[[1], {a: 1}]"]
+                generator = ResourceGenerator()
+        expected = [[1], {"a": 1}]
+        self.assertEqual(generator.as_dict()["linmin"]["nested"], expected)
+        self.assertEqual(yaml.safe_load(generator.as_yaml())["linmin"]["nested"], expected)
+        self.assertEqual(json.loads(generator.as_json())["linmin"]["nested"], expected)
+
+    def test_nodes_are_records(self):
+        generator = self._generator()
+        for node in generator.resources.values():
+            self.assertIsInstance(node, _NodeRecord)
+
+        # Records are expanded when the resources are returned or written
+        resources = generator.as_dict()
+        for node in resources.values():
+            self.assertIs(type(node), dict)
+        self.assertEqual(yaml.safe_load(generator.as_yaml()), resources)
+        self.assertEqual(json.loads(generator.as_json()), resources)
+
+
+class TestMasterCache(TestCase):
+    # pylint: disable=invalid-name
+    MINE = "grains.items"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.mine = load_test_data("mine.yaml")
+
+    def _dump(self, filename, data):
+        filename = path.join(self.tmpdir.name, filename)
+        os.makedirs(path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as stream:
+            salt.payload.dump(data, stream)
+
+    def _write_cache(self, legacy=False):
+        for minion, grains in self.mine.items():
+            entry = grains
+            if minion == "winmin":
+                # Mine data stored with a minion-side ACL
+                entry = {"__saltmine_acl__": 1, "__data__": grains, "allow_tgt": "*"}
+            if legacy:
+                self._dump(path.join("minions", minion, "mine.p"), {self.MINE: entry})
+                self._dump(path.join("minions", minion, "data.p"), {"grains": grains})
+            else:
+                self._dump(path.join("mine", minion + ".p"), {self.MINE: entry})
+                self._dump(path.join("grains", minion + ".p"), grains)
+
+    def _generate(self, tgt, tgt_type="glob", **options):
+        caller = MockCaller()
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", caller):
+                parser.options.backend = "master-cache"
+                parser.options.master_cache_dir = self.tmpdir.name
+                parser.config["id"] = "rundeck"
+                parser.config["tgt"] = tgt
+                parser.config["selected_target_option"] = tgt_type
+                vars(parser.options).update(options)
+                generator = ResourceGenerator()
+        caller.cmd.assert_not_called()
+        return generator
+
+    def test_matches_caller(self):
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()):
+                parser.options.attributes = ["os"]
+                expected = ResourceGenerator().resources
+        for legacy in (False, True):
+            self._write_cache(legacy)
+            self.assertEqual(self._generate("*", attributes=["os"]).resources, expected)
+
+    def test_targets(self):
+        self._write_cache()
+        self.assertEqual(list(self._generate("lin*").resources), ["linmin"])
+        self.assertEqual(
+            list(self._generate("kernel:Windows", "grain").resources), ["winmin"]
+        )
+        self.assertEqual(
+            list(self._generate(["winmin", "other"], "list").resources), ["winmin"]
+        )
+        self.assertEqual(
+            list(self._generate("10.0.1.0/24", "ipcidr").resources), ["linmin"]
+        )
+
+    def test_minion_side_acl(self):
+        for allow_tgt, allow_tgt_type, allowed in (
+            ("rundeck", "glob", True),
+            ("other*", "glob", False),
+            ("rundeck,other", "list", True),
+            ("role:rundeck", "grain", True),
+            ("role:other", "grain", False),
+            ("G@role:rundeck", "compound", False),
+        ):
+            self._write_cache()
+            self._dump(path.join("grains", "rundeck.p"), {"role": "rundeck"})
+            self._dump(
+                path.join("mine", "winmin.p"),
+                {
+                    self.MINE: {
+                        "__saltmine_acl__": 1,
+                        "__data__": self.mine["winmin"],
+                        "allow_tgt": allow_tgt,
+                        "allow_tgt_type": allow_tgt_type,
+                    }
+                },
+            )
+            self.assertEqual("winmin" in self._generate("*").resources, allowed, allow_tgt)
+
+    def test_profiles(self):
+        self._write_cache()
+        profiles = [
+            {
+                "name": name,
+                "output": path.join(self.tmpdir.name, name + ".yaml"),
+                "tgt": tgt,
+                "tgt_type": "glob",
+                "attributes": ["os"],
+                "tags": [],
+                "static": {},
+            }
+            for name, tgt in (("linux", "lin*"), ("windows", "win*"))
+        ]
+        generator = self._generate("*", profiles=profiles)
+        self.assertEqual(generator.write_profiles(), 0)
+        for profile, minion in zip(profiles, ("linmin", "winmin")):
+            with open(profile["output"]) as stream:
+                self.assertEqual(list(yaml.safe_load(stream)), [minion])
+
+    def test_server_node_grains(self):
+        self._write_cache()
+        grains = load_test_data("config.yaml")["grains"]
+        with patch("salt.loader.grains", Mock(return_value=grains)) as loader:
+            generator = self._generate("*", include_server_node=True)
+        loader.assert_called_once()
+        self.assertEqual(generator.resources["localhost"]["osName"], grains["kernel"])
+
+    def test_missing_cache(self):
+        with self.assertLogs("salt-gen-resource", "ERROR"):
+            self.assertEqual(self._generate("*").resources, {})
+
+
+class TestBackends(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _generate(self, tgt="*", tgt_type="glob", **options):
+        caller = MockCaller()
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", caller):
+                parser.config["tgt"] = tgt
+                parser.config["selected_target_option"] = tgt_type
+                parser.options.attributes = ["os", "virtual"]
+                parser.options.tags = ["colors"]
+                vars(parser.options).update(options)
+                generator = ResourceGenerator()
+        if options.get("backend", "caller") != "caller":
+            caller.cmd.assert_not_called()
+        return generator
+
+    def test_fixture_formats(self):
+        mine = load_test_data("mine.yaml")
+        expected = self._generate().resources
+        fixtures = {
+            "mine.yaml": lambda stream: yaml.safe_dump(mine, stream),
+            "mine.json": lambda stream: json.dump(mine, stream),
+        }
+        for filename, dump in fixtures.items():
+            fixture = path.join(self.tmpdir.name, filename)
+            with open(fixture, "w") as stream:
+                dump(stream)
+            generator = self._generate(backend="fixture", fixture_file=fixture)
+            self.assertEqual(generator.resources, expected)
+
+        fixture = path.join(self.tmpdir.name, "mine.p")
+        with open(fixture, "wb") as stream:
+            salt.payload.dump(mine, stream)
+        generator = self._generate(backend="fixture", fixture_file=fixture)
+        self.assertEqual(generator.resources, expected)
+
+        generator = self._generate(
+            "kernel:Linux", "grain", backend="fixture", fixture_file=fixture
+        )
+        self.assertEqual(list(generator.resources), ["linmin"])
+
+    def test_source_in_cache_key(self):
+        mine = load_test_data("mine.yaml")
+        cache_dir = path.join(self.tmpdir.name, "cache")
+        for name, data in (("mine.yaml", mine), ("other.yaml", {"linmin": mine["linmin"]})):
+            fixture = path.join(self.tmpdir.name, name)
+            with open(fixture, "w") as stream:
+                yaml.safe_dump(data, stream)
+            generator = self._generate(
+                backend="fixture", fixture_file=fixture, cache_ttl=60, cache_dir=cache_dir
+            )
+            self.assertEqual(len(generator.as_dict()), len(data))
+        for count in (2, 3):
+            generator = self._generate(
+                backend="synthetic", synthetic_count=count, cache_ttl=60, cache_dir=cache_dir
+            )
+            self.assertEqual(len(generator.as_dict()), count)
+
+    def test_synthetic(self):
+        generator = self._generate(backend="synthetic", synthetic_count=50)
+        self.assertEqual(len(generator.resources), 50)
+        self.assertEqual(
+            generator.resources,
+            self._generate(backend="synthetic", synthetic_count=50).resources,
+        )
+        generator = self._generate(
+            "minion00000*", backend="synthetic", synthetic_count=50
+        )
+        self.assertEqual(len(generator.resources), 10)
+        self.assertEqual(
+            SyntheticBackend.minions(3, seed=1), SyntheticBackend.minions(3, seed=1)
+        )
+
+
+    def test_profiles(self):
+        fixture = path.join(self.tmpdir.name, "mine.yaml")
+        with open(fixture, "w") as stream:
+            yaml.safe_dump(load_test_data("mine.yaml"), stream)
+        for options, targets in (
+            ({"backend": "fixture", "fixture_file": fixture}, ("lin*", "win*")),
+            ({"backend": "synthetic", "synthetic_count": 10}, ("minion000000", "minion000001")),
+        ):
+            profiles = [
+                {
+                    "name": tgt,
+                    "output": path.join(self.tmpdir.name, "profile{}.yaml".format(index)),
+                    "tgt": tgt,
+                    "tgt_type": "glob",
+                    "attributes": ["os"],
+                    "tags": [],
+                    "static": {},
+                }
+                for index, tgt in enumerate(targets)
+            ]
+            generator = self._generate(profiles=profiles, **options)
+            self.assertEqual(generator.write_profiles(), 0)
+            self.assertTrue(generator.backend.matches_locally)
+            for profile in profiles:
+                with open(profile["output"]) as stream:
+                    self.assertEqual(len(yaml.safe_load(stream)), 1)
+
+class TestTransportBackend(TestCase):
+    def _generate(self, include_server_node=False, attributes=("os",)):
+        channel = Mock()
+        channel.__enter__ = Mock(return_value=channel)
+        channel.__exit__ = Mock(return_value=False)
+        channel.send.return_value = load_test_data("mine.yaml")
+        dns = {"master_ip": "127.0.0.1", "master_uri": "tcp://127.0.0.1:4506"}
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.minion.resolve_dns", Mock(return_value=dns)), patch(
+                "salt.crypt.SAuth"
+            ) as auth, patch(
+                "salt.channel.client.ReqChannel.factory", Mock(return_value=channel)
+            ) as factory, patch(
+                "salt.client.Caller"
+            ) as caller:
+                parser.config["id"] = "rundeck"
+                parser.config["master"] = ["salt1", "salt2"]
+                parser.options.backend = "transport"
+                parser.options.include_server_node = include_server_node
+                parser.options.attributes = list(attributes)
+                generator = ResourceGenerator()
+        caller.assert_not_called()
+        auth.return_value.gen_token.assert_called_once_with(b"salt")
+        opts = factory.call_args[0][0]
+        self.assertEqual(opts["master"], "salt1")
+        self.assertEqual(opts["master_uri"], dns["master_uri"])
+        return generator, channel.send.call_args[0][0]
+
+    def test_mine_request(self):
+        generator, load = self._generate()
+        self.assertEqual(load["cmd"], "_mine_get")
+        self.assertEqual(load["tgt"], "*")
+        self.assertEqual(load["fun"], "grains.items")
+        self.assertEqual(load["tgt_type"], "glob")
+        self.assertIn("tok", load)
+        self.assertEqual(set(generator.resources), set(load_test_data("mine.yaml")))
+
+    def test_server_node_grains(self):
+        grains = load_test_data("config.yaml")["grains"]
+        with patch("salt.loader.grains") as loader:
+            generator, _ = self._generate(include_server_node=True)
+        loader.assert_not_called()
+        self.assertEqual(generator.resources["localhost"]["os"], grains["os"])
+
+        # Grains that are neither core nor static grains are loaded
+        with patch("salt.loader.grains", Mock(return_value=grains)) as loader:
+            generator, _ = self._generate(True, ["os", "unknown_grain"])
+        loader.assert_called_once()
+
+
+class TestTimings(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def _generate(self, stream=False, **options):
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()):
+                parser.options.stream = stream
+                parser.options.attributes = ["os", "virtual"]
+                parser.options.tags = ["colors", "missing"]
+                vars(parser.options).update(options)
+                with self.assertLogs("salt-gen-resource", "WARNING"):
+                    generator = ResourceGenerator()
+                    generator.write(io.StringIO())
+                return generator
+
+    def test_timings(self):
+        for stream in (False, True):
+            stats_file = path.join(self.tmpdir.name, "stats.json")
+            generator = self._generate(stream, timings=True, stats_file=stats_file)
+            with patch("sys.stdout", io.StringIO()) as stdout:
+                generator.write_stats()
+            self.assertEqual(stdout.getvalue(), "")
+            with open(stats_file) as stream_:
+                stats = json.load(stream_)
+
+            stages = {"import", "config", "mine", "write"}
+            stages.update(["write"] if stream else ["convert", "render"])
+            self.assertEqual(set(stats["timings"]), stages)
+            for timing in stats["timings"].values():
+                self.assertGreaterEqual(timing["wall"], 0)
+                self.assertGreaterEqual(timing["cpu"], 0)
+            self.assertEqual(stats["counts"]["minions"], 2)
+            self.assertEqual(stats["counts"]["nodes"], 2)
+            # One summary for the tag that is missing on both minions
+            self.assertEqual(stats["counts"]["warnings"], 1)
+            self.assertEqual(stats["counts"]["tags"], 4)
+
+    def test_timings_on_stderr(self):
+        generator = self._generate(timings=True)
+        with patch("sys.stderr", io.StringIO()) as stderr:
+            generator.write_stats()
+        self.assertIn("timings", json.loads(stderr.getvalue()))
+
+    def test_profile(self):
+        import pstats  # pylint: disable=import-outside-toplevel
+
+        profile_file = path.join(self.tmpdir.name, "convert.prof")
+        self._generate(profile_file=profile_file)
+        functions = {function for _, _, function in pstats.Stats(profile_file).stats}
+        self.assertIn("_minion_node", functions)
+
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.metrics_file = path.join(self.tmpdir.name, "rundeck.prom")
+
+    def _metrics(self, stream=False, workers=1):
+        caller = MockCaller()
+        for grains in caller.cmd.return_value.values():
+            grains["locale_info"] = {"defaultlanguage": "en_US"}
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", caller):
+                parser.options.stream = stream
+                parser.options.workers = workers
+                parser.options.metrics_file = self.metrics_file
+                # Dictionaries and booleans are skipped
+                parser.options.attributes = ["os", "locale_info"]
+                parser.options.tags = ["colors", "locale_info", "virtual"]
+                with self.assertLogs("salt-gen-resource", "WARNING"):
+                    generator = ResourceGenerator()
+                    output = io.StringIO()
+                    generator.write(output)
+                generator.report()
+        metrics = {}
+        with open(self.metrics_file) as stream_:
+            for line in stream_:
+                if not line.startswith("#"):
+                    name, value = line.rsplit(" ", 1)
+                    metrics[name] = float(value)
+        return metrics, output.getvalue()
+
+    def test_metrics(self):
+        for stream, workers in ((False, 1), (True, 1), (False, 2)):
+            metrics, output = self._metrics(stream, workers)
+            self.assertEqual(metrics["salt_gen_resource_minions"], 2)
+            self.assertEqual(metrics["salt_gen_resource_nodes"], 2)
+            self.assertEqual(
+                metrics['salt_gen_resource_skipped_grains{kind="attribute"}'], 2
+            )
+            self.assertEqual(metrics['salt_gen_resource_skipped_grains{kind="tag"}'], 4)
+            self.assertEqual(
+                metrics["salt_gen_resource_output_bytes"], len(output.encode("utf-8"))
+            )
+            self.assertGreater(
+                metrics["salt_gen_resource_duration_seconds"],
+                metrics["salt_gen_resource_mine_duration_seconds"],
+            )
+            self.assertIn("salt_gen_resource_serialization_duration_seconds", metrics)
+            self.assertAlmostEqual(
+                metrics["salt_gen_resource_last_run_timestamp_seconds"],
+                time.time(),
+                delta=60,
+            )
+
+    def _read(self):
+        with open(self.metrics_file) as stream:
+            return stream.read()
+
+    def test_cache_hit(self):
+        argv = ["--cache-ttl", "60", "--cache-dir", self.tmpdir.name]
+        argv += ["--metrics-file", self.metrics_file, "*"]
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()):
+                parser.options.cache_ttl = 60
+                parser.options.cache_dir = self.tmpdir.name
+                parser.options.metrics_file = self.metrics_file
+                ResourceGenerator(argv).report()
+                self.assertIn("salt_gen_resource_cache_hit 0\n", self._read())
+                generator = ResourceGenerator(argv)
+                generator.write(io.StringIO())
+                generator.report()
+        metrics = self._read()
+        self.assertIn("salt_gen_resource_cache_hit 1\n", metrics)
+        self.assertIn("salt_gen_resource_nodes 2\n", metrics)
+
+        # Served without loading Salt
+        os.unlink(self.metrics_file)
+        stdout = io.StringIO()
+        script = path.join(path.dirname(path.abspath(__file__)), "SaltGenResource.py")
+        with patch("sys.argv", [script] + argv), patch("sys.stdout", stdout):
+            runpy.run_path(script, run_name="__main__")
+        metrics = self._read()
+        self.assertIn("salt_gen_resource_cache_hit 1\n", metrics)
+        self.assertIn("salt_gen_resource_nodes 2\n", metrics)
+        self.assertIn(
+            "salt_gen_resource_output_bytes {}\n".format(len(stdout.getvalue())), metrics
+        )
+
+    def test_cache_hit_stats(self):
+        stats_file = path.join(self.tmpdir.name, "stats.json")
+        argv = ["--cache-ttl", "60", "--cache-dir", self.tmpdir.name]
+        argv += ["--stats-file", stats_file, "*"]
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()):
+                parser.options.cache_ttl = 60
+                parser.options.cache_dir = self.tmpdir.name
+                ResourceGenerator(argv).write(io.StringIO())
+        self.assertIsNone(_cached_output(argv[:-1] + ["--timings", "*"]))
+
+        # Served without loading Salt
+        stdout = io.StringIO()
+        script = path.join(path.dirname(path.abspath(__file__)), "SaltGenResource.py")
+        with patch("sys.argv", [script] + argv), patch("sys.stdout", stdout):
+            runpy.run_path(script, run_name="__main__")
+        with open(stats_file) as stream:
+            stats = json.load(stream)
+        self.assertTrue(stats["cache_hit"])
+        self.assertEqual(
+            stats["output_sha256"], hashlib.sha256(stdout.getvalue().encode("utf-8")).hexdigest()
+        )
+
+    def test_metrics_disabled(self):
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()):
+            with patch("salt.client.Caller", MockCaller()):
+                ResourceGenerator().report()
+        self.assertFalse(path.exists(self.metrics_file))
+
+
+class TestDiagnostics(TestCase):
+    def _generate(self, level="WARNING", workers=1, **options):
+        caller = MockCaller()
+        for grains in caller.cmd.return_value.values():
+            grains["locale_info"] = {"defaultlanguage": "en_US"}
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", caller):
+                parser.options.workers = workers
+                parser.options.attributes = ["colors", "missing", "locale_info"]
+                parser.options.tags = ["virtual", "missing"]
+                vars(parser.options).update(options)
+                with self.assertLogs("salt-gen-resource", level) as logs:
+                    ResourceGenerator()
+        return logs.output
+
+    def test_summaries(self):
+        self.assertEqual(
+            self._generate(),
+            [
+                "WARNING:salt-gen-resource:Grain 'colors' is a list on 2 minions. "
+                "First item was selected",
+                "WARNING:salt-gen-resource:Grain 'locale_info' ignored on 2 minions "
+                "because its type is unsupported",
+                "WARNING:salt-gen-resource:Requested grain 'missing' is not available "
+                "on 2 minions",
+                "WARNING:salt-gen-resource:Tags not added for grain 'virtual' on "
+                "2 minions because its data type is not supported",
+            ],
+        )
+
+    def test_examples(self):
+        for workers in (1, 2):
+            output = self._generate(workers=workers, warn_examples=1)
+            self.assertEqual(
+                output[2],
+                "WARNING:salt-gen-resource:Requested grain 'missing' is not "
+                "available on 2 minions (linmin, ...)",
+            )
+            output = self._generate(workers=workers, warn_examples=5)
+            self.assertEqual(
+                output[2],
+                "WARNING:salt-gen-resource:Requested grain 'missing' is not "
+                "available on 2 minions (linmin, winmin)",
+            )
+
+    def test_debug_details(self):
+        output = self._generate()
+        self.assertFalse([line for line in output if "minion: linmin" in line])
+        logger = logging.getLogger("salt-gen-resource")
+        level = logger.level
+        logger.setLevel(logging.DEBUG)
+        self.addCleanup(logger.setLevel, level)
+        output = self._generate("DEBUG")
+        self.assertIn(
+            "DEBUG:salt-gen-resource:Requested grain 'missing' is not available "
+            "on minion: linmin",
+            output,
+        )
+
+
+class TestMatchTarget(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mine = load_test_data("mine.yaml")
+
+    def _matches(self, tgt, tgt_type):
+        return sorted(
+            minion
+            for minion, grains in self.mine.items()
+            if _match_target(minion, grains, tgt, tgt_type)
+        )
+
+    def test_glob(self):
+        self.assertEqual(self._matches("lin*", "glob"), ["linmin"])
+        self.assertEqual(self._matches("*", "glob"), ["linmin", "winmin"])
+
+    def test_pcre(self):
+        self.assertEqual(self._matches("w.*min", "pcre"), ["winmin"])
+
+    def test_list(self):
+        self.assertEqual(self._matches(["winmin", "other"], "list"), ["winmin"])
+        self.assertEqual(self._matches("linmin,other", "list"), ["linmin"])
+
+    def test_grain(self):
+        self.assertEqual(self._matches("kernel:Win*", "grain"), ["winmin"])
+        self.assertEqual(self._matches("colors:red", "grain"), ["linmin", "winmin"])
+        self.assertEqual(self._matches("os:Red.*", "grain_pcre"), ["linmin"])
+
+    def test_ipcidr(self):
+        self.assertEqual(self._matches("10.0.1.0/24", "ipcidr"), ["linmin"])
+        self.assertEqual(self._matches("10.0.2.20", "ipcidr"), ["winmin"])
+        self.assertEqual(self._matches("192.168.0.0/16", "ipcidr"), [])
+
+    def test_unsupported(self):
+        with self.assertRaises(ValueError):
+            _match_target("linmin", {}, "webservers", "nodegroup")
+
+
+class TestProfiles(TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.output_dir.cleanup)
+
+    def _write_profiles(self, profiles):
+        filename = path.join(self.output_dir.name, "profiles.yaml")
+        with open(filename, "w") as stream:
+            yaml.safe_dump(profiles, stream)
+        return SaltNodesCommandParser.load_profiles(filename)
+
+    def _output(self, name):
+        with open(path.join(self.output_dir.name, name), "r") as stream:
+            return yaml.safe_load(stream)
+
+    def test_single_mine_call(self):
+        profiles = self._write_profiles(
+            [
+                {
+                    "name": "linux",
+                    "target": "lin*",
+                    "attributes": "os,os_family",
+                    "output": path.join(self.output_dir.name, "linux.yaml"),
+                },
+                {
+                    "name": "windows",
+                    "target": "kernel:Windows",
+                    "target_type": "grain",
+                    "tags": ["colors"],
+                    "static": ["username=admin"],
+                    "output": path.join(self.output_dir.name, "windows.yaml"),
+                },
+            ]
+        )
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()) as caller:
+                parser.options.profiles = profiles
+                self.assertEqual(ResourceGenerator().write_profiles(), 0)
+                caller.cmd.assert_called_once()
+                self.assertEqual(
+                    caller.cmd.call_args[0][1], "lin* or G@kernel:Windows"
+                )
+
+        linux = self._output("linux.yaml")
+        self.assertEqual(list(linux), ["linmin"])
+        self.assertEqual(linux["linmin"]["os_family"], "RedHat")
+        self.assertNotIn("tags", linux["linmin"])
+
+        windows = self._output("windows.yaml")
+        self.assertEqual(list(windows), ["winmin"])
+        self.assertEqual(windows["winmin"]["username"], "admin")
+        self.assertEqual(sorted(windows["winmin"]["tags"]), ["green", "red"])
+        self.assertNotIn("os", windows["winmin"])
+
+    def test_remote_target(self):
+        profiles = self._write_profiles(
+            [
+                {
+                    "target": "lin*",
+                    "output": path.join(self.output_dir.name, "linux.yaml"),
+                },
+                {
+                    "target": "webservers",
+                    "target_type": "nodegroup",
+                    "output": path.join(self.output_dir.name, "web.yaml"),
+                },
+            ]
+        )
+        with patch("SaltGenResource.SaltNodesCommandParser", MockParser()) as parser:
+            with patch("salt.client.Caller", MockCaller()) as caller:
+                parser.options.profiles = profiles
+                ResourceGenerator().write_profiles()
+                self.assertEqual(caller.cmd.call_count, 2)
+                self.assertEqual(caller.cmd.call_args[0][1], "webservers")
+
+        self.assertEqual(len(self._output("web.yaml")), 2)
+
+    def test_invalid_profiles(self):
+        with self.assertRaises(ValueError):
+            self._write_profiles([{"target": "*"}])
+        with self.assertRaises(ValueError):
+            self._write_profiles(
+                [{"target": "*", "target_type": "bogus", "output": "nodes.yaml"}]
+            )
+
+    def test_invalid_targets(self):
+        for target, target_type in ((42, "glob"), (None, "glob"), ("", "glob"), ([1, 2], "list")):
+            with self.assertRaisesRegex(ValueError, "invalid target"):
+                self._write_profiles(
+                    [{"target": target, "target_type": target_type, "output": "nodes.yaml"}]
+                )
+        profiles = self._write_profiles(
+            [{"target": ["winmin", "linmin"], "target_type": "list", "output": "nodes.yaml"}]
+        )
+        self.assertEqual(profiles[0]["tgt"], ["linmin", "winmin"])
+
+    def test_target_types(self):
+        # The same target types as --target-spec
+        profiles = self._write_profiles(
+            [{"target": "role:web", "target_type": "pillar_exact", "output": "nodes.yaml"}]
+        )
+        self.assertEqual(profiles[0]["tgt_type"], "pillar_exact")
+
+    def test_invalid_values(self):
+        for item, message in (
+            ({"output": None}, "invalid output"),
+            ({"attributes": None}, "invalid attributes"),
+            ({"tags": 5}, "invalid tags"),
+            ({"tags": ["os", 5]}, "invalid tags"),
+        ):
+            with self.assertRaisesRegex(ValueError, message):
+                self._write_profiles([dict({"target": "*", "output": "nodes.yaml"}, **item)])
+
+        with self.assertRaisesRegex(ValueError, "used more than once"):
+            self._write_profiles(
+                [
+                    {"name": "web", "target": "web*", "output": "web.yaml"},
+                    {"name": "web", "target": "db*", "output": "db.yaml"},
+                ]
+            )
+        with self.assertRaisesRegex(ValueError, "like another profile"):
+            self._write_profiles(
+                [
+                    {"name": "web", "target": "web*", "output": "nodes.yaml"},
+                    {"name": "db", "target": "db*", "output": "./nodes.yaml"},
+                ]
+            )
+
+
 class MockParser:
 
     ignore_attributes = SaltNodesCommandParser.ignore_attributes